@@ -0,0 +1,267 @@
+# Micro benchmarks for the copy trader, run without network access.
+#
+#   python benchmark.py signing     signatures per second, before and after precomputing the HMAC state
+#   python benchmark.py plan        rebalance plans per second for a synthetic book
+#   python benchmark.py decode      response decoding per JSON backend, with and without field projection
+#   python benchmark.py concurrency many requests in flight: a thread per request against AsyncCfApiMethods on one thread
+#   python benchmark.py cycle       full copy cycles against the local mock server (mock_server.py)
+
+import argparse
+import asyncio
+import base64
+import contextlib
+import hashlib
+import hmac
+import io
+import itertools
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import main as copytrader
+from main import AsyncCfApiMethods, cfApiMethods, cfJsonDecoder, cfInstrumentsResponse, cfTickersResponse, cfConnectionPool, cfResponse, Follower, InstrumentCache, Snapshot, plan_rebalance, run_cycle
+from mock_server import MockExchange, start_mock_server
+
+# sign_message as it was before the HMAC state was precomputed, kept for comparison
+def legacy_sign_message(apiPrivateKey, endpoint, postData, nonce=""):
+    if endpoint.startswith('/derivatives'):
+        endpoint = endpoint[len('/derivatives'):]
+    message = postData + nonce + endpoint
+    sha256_hash = hashlib.sha256()
+    sha256_hash.update(message.encode('utf8'))
+    hash_digest = sha256_hash.digest()
+    secretDecoded = base64.b64decode(apiPrivateKey)
+    hmac_digest = hmac.new(secretDecoded, hash_digest, hashlib.sha512).digest()
+    return base64.b64encode(hmac_digest)
+
+# calls fn repeatedly for about `seconds`, returns calls per second
+def rate(fn, seconds):
+    n = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(100):
+            fn()
+        n += 100
+        now = time.perf_counter()
+        if now >= deadline:
+            return n / (now - start)
+
+def bench_signing(seconds):
+    apiPrivateKey = base64.b64encode(os.urandom(64)).decode()
+    client = cfApiMethods("https://futures.kraken.com", apiPublicKey="key", apiPrivateKey=apiPrivateKey)
+    endpoint = "/derivatives/api/v3/sendorder"
+    postData = "orderType=lmt&symbol=PF_XBTUSD&side=buy&size=0.001&limitPrice=60000.5"
+    nonce = client.get_nonce()
+
+    assert legacy_sign_message(apiPrivateKey, endpoint, postData, nonce) == client.sign_message(endpoint, postData, nonce)
+
+    before = rate(lambda: legacy_sign_message(apiPrivateKey, endpoint, postData, nonce), seconds)
+    after = rate(lambda: client.sign_message(endpoint, postData, nonce), seconds)
+    print('sign_message before: %10.0f signatures/s' % before)
+    print('sign_message after:  %10.0f signatures/s  (%.2fx)' % (after, after / before))
+
+    # nonces from concurrent threads must all be unique and increasing per thread
+    nonces = []
+    def take():
+        local = [ int(client.get_nonce()) for _ in range(20000) ]
+        assert local == sorted(local) and len(set(local)) == len(local)
+        nonces.extend(local)
+    threads = [ threading.Thread(target=take) for _ in range(8) ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    assert len(set(nonces)) == len(nonces)
+    print('get_nonce, 8 threads: %10.0f nonces/s, all unique' % (len(nonces) / elapsed))
+
+# a snapshot with `symbols` instruments, the source holding `positions` of them and you holding a mix of them
+def synthetic_snapshot(symbols, positions, seed=1):
+    rnd = random.Random(seed)
+    names = [ 'PF_S%04dUSD' % n for n in range(symbols) ]
+    instruments = [ {'symbol': s, 'tickSize': rnd.choice([0.5, 0.01, 0.0001]), 'contractValueTradePrecision': rnd.choice([0, 2, 4])} for s in names ]
+    tickers = [ {'symbol': s, 'markPrice': rnd.uniform(0.1, 60000)} for s in names ]
+    held = rnd.sample(names, positions)
+    source_positions = [ {'symbol': s, 'side': rnd.choice(['long', 'short']), 'size': rnd.uniform(0.01, 100)} for s in held ]
+    your_positions = [ {'symbol': s, 'side': rnd.choice(['long', 'short']), 'size': rnd.uniform(0.0001, 1)} for s in rnd.sample(names, positions) ]
+    return Snapshot(instruments, tickers, {'accounts': {'flex': {'portfolioValue': 250000}}}, {'accounts': {'flex': {'portfolioValue': 2500}}},
+                    source_positions, your_positions, timings={}, elapsed=0)
+
+def bench_plan(seconds, symbols, positions):
+    snapshot = synthetic_snapshot(symbols, positions)
+    plan = plan_rebalance(snapshot)
+    per_second = rate(lambda: plan_rebalance(snapshot), seconds)
+    print('plan_rebalance, %d instruments, %d source positions: %8.0f plans/s, %.1f us/plan, %d orders' % (
+        symbols, positions, per_second, 1e6 / per_second, len(plan.orders())))
+
+# bytes held by the decoded object
+def retained(fn):
+    tracemalloc.start()
+    try:
+        obj = fn()
+        return tracemalloc.get_traced_memory()[0]
+    finally:
+        del obj
+        tracemalloc.stop()
+
+def bench_decode(seconds, symbols):
+    backends = [ b for b, module in (('msgspec', copytrader.msgspec), ('orjson', copytrader.orjson), ('json', True)) if module ]
+    for n in symbols:
+        exchange = MockExchange(symbols=n, positions=0)
+        for endpoint, schema in (('instruments', cfInstrumentsResponse), ('tickers', cfTickersResponse)):
+            data = json.dumps(exchange.handle('GET', '/derivatives/api/v3/' + endpoint, {}, {}, None)[1]).encode()
+            print('%s, %d instruments, %d kB' % (endpoint, n, len(data) // 1000))
+            # how the responses were parsed before: bytes to str, then the standard library
+            legacy = lambda: json.loads(data.decode('utf-8'))
+            print('  %-8s %-10s %8.2f ms %8d kB retained' % ('str+json', 'full', 1000 / rate(legacy, seconds), retained(legacy) // 1000))
+            for backend in backends:
+                decoder = cfJsonDecoder(backend)
+                for projected in (None, schema):
+                    fn = lambda: decoder.decode(data, projected)
+                    print('  %-8s %-10s %8.2f ms %8d kB retained' % (backend, 'projected' if projected else 'full', 1000 / rate(fn, seconds), retained(fn) // 1000))
+
+# the transport before connection pooling: urlopen with a new connection for every request
+class UrlopenTransport(object):
+    def request(self, method, url, body=None, headers=None, timeout=10, checkCertificate=True):
+        response = urllib.request.urlopen(urllib.request.Request(url, body, headers or {}, method=method), timeout=timeout)
+        return cfResponse(url, response.status, response.reason, response.headers, response.read())
+
+    def close(self):
+        pass
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+# runs `cycles` copy cycles against a fresh mock exchange and returns the measurements of one configuration
+def measure_cycles(cycles, symbols, positions, followers, transport, chunkSize, snapshot, latency, connectLatency, orders='reconcile', volatility=0):
+    exchange = MockExchange(symbols=symbols, positions=positions, latency=latency, connectLatency=connectLatency)
+    server = start_mock_server(exchange)
+    apiPath = 'http://127.0.0.1:%d' % server.server_port
+    pool = cfConnectionPool(maxSize=4 + 2 * followers) if transport == 'pooled' else UrlopenTransport()
+    secret = base64.b64encode(b'mock-secret').decode()
+    cfPublic = cfApiMethods(apiPath, pool=pool, projectFields=True)
+    cfSource = cfApiMethods(apiPath, apiPublicKey='source', apiPrivateKey=secret, pool=pool, projectFields=True)
+    clients = [ Follower('f%d' % n, cfApiMethods(apiPath, apiPublicKey='follower%d' % n, apiPrivateKey=secret, pool=pool, projectFields=True)) for n in range(followers) ]
+    # sequential runs every snapshot call and follower one after another, like the script did before
+    executor = ThreadPoolExecutor(max_workers=1 if snapshot == 'sequential' else 4 + 2 * followers)
+
+    copytrader.batchSize = chunkSize  # submit_orders reads the setting at call time
+    copytrader.reconcileOrders = orders == 'reconcile'
+    copytrader.chaseDeadline = 0  # the cycle itself, not the time the orders take to fill
+    durations = []
+    with tempfile.TemporaryDirectory() as directory:
+        cache = InstrumentCache(cfPublic, path=os.path.join(directory, 'instruments.json'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(cycles):
+                if volatility:
+                    exchange.move_prices(volatility)
+                start = time.perf_counter()
+                run_cycle(cfPublic, cfSource, clients, cache, executor=executor)
+                durations.append(time.perf_counter() - start)
+    executor.shutdown()
+    pool.close()
+    server.shutdown()
+    server.server_close()
+
+    return {
+        'p50': percentile(durations, 0.5),
+        'p99': percentile(durations, 0.99),
+        'requests': sum(exchange.requests.values()) / cycles,
+        'connections': exchange.connections / cycles,
+        'orders_per_second': exchange.ordersPlaced / sum(durations),
+    }
+
+# `requests` order book requests with `inFlight` of them at a time, through threads and the sync client or
+# through coroutines and the async client, each with its own pool of `inFlight` connections
+def bench_concurrency(requests, inFlight, latency):
+    exchange = MockExchange(symbols=max(requests, 10), positions=0, latency=latency)
+    server = start_mock_server(exchange)
+    apiPath = 'http://127.0.0.1:%d' % server.server_port
+    symbols = sorted(exchange.markPrices)[:requests]
+
+    client = cfApiMethods(apiPath, pool=cfConnectionPool(maxSize=inFlight))
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=inFlight) as executor:
+        list(executor.map(client.get_orderbook, symbols))
+    elapsed = time.perf_counter() - start
+    client.pool.close()
+    print('%-8s %6d requests, %4d in flight: %7.3f s, %7.0f requests/s, %4d client threads' % ('threads', requests, inFlight, elapsed, requests / elapsed, inFlight))
+
+    async def run():
+        client = AsyncCfApiMethods(apiPath, pool=copytrader.cfAsyncConnectionPool(maxSize=inFlight))
+        start = time.perf_counter()
+        await client.batch((client.get_orderbook(s) for s in symbols), limit=inFlight)
+        elapsed = time.perf_counter() - start
+        client.pool.close()
+        return elapsed
+    elapsed = asyncio.run(run())
+    print('%-8s %6d requests, %4d in flight: %7.3f s, %7.0f requests/s, %4d client threads' % ('asyncio', requests, inFlight, elapsed, requests / elapsed, 1))
+    server.shutdown()
+    server.server_close()
+
+def bench_cycle(args):
+    print('%9s %9s %9s %7s %10s %9s %9s %9s %9s %9s %9s' % ('positions', 'followers', 'transport', 'batch', 'snapshot', 'orders', 'p50 ms', 'p99 ms', 'req/cyc', 'conn/cyc', 'orders/s'))
+    for positions, followers, transport, chunkSize, snapshot, orders in itertools.product(args.positions, args.followers, args.transports, args.batch_sizes, args.snapshots, args.orders):
+        m = measure_cycles(args.cycles, args.symbols, positions, followers, transport, chunkSize, snapshot, args.latency, args.connect_latency, orders, args.volatility)
+        print('%9d %9d %9s %7d %10s %9s %9.1f %9.1f %9.1f %9.1f %9.1f' % (positions, followers, transport, chunkSize, snapshot, orders,
+              m['p50'] * 1000, m['p99'] * 1000, m['requests'], m['connections'], m['orders_per_second']))
+
+def int_list(value):
+    return [ int(v) for v in value.split(',') ]
+
+def str_list(value):
+    return value.split(',')
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy trader benchmarks.")
+    sub = parser.add_subparsers(dest="benchmark", required=True)
+    signing = sub.add_parser("signing", help="request signing throughput")
+    signing.add_argument("--seconds", type=float, default=2, help="duration of each measurement")
+    plan = sub.add_parser("plan", help="rebalance planning without network")
+    plan.add_argument("--seconds", type=float, default=2, help="duration of each measurement")
+    plan.add_argument("--symbols", type=int, default=500, help="listed instruments")
+    plan.add_argument("--positions", type=int, default=50, help="positions held by the source and by you")
+    decode = sub.add_parser("decode", help="response decoding per JSON backend")
+    decode.add_argument("--seconds", type=float, default=1, help="duration of each measurement")
+    decode.add_argument("--symbols", type=int_list, default=[300, 3000], help="comma separated numbers of listed instruments")
+    concurrency = sub.add_parser("concurrency", help="many requests in flight, threads against asyncio")
+    concurrency.add_argument("--requests", type=int, default=1000, help="order book requests per run")
+    concurrency.add_argument("--in-flight", type=int_list, default=[10, 50, 100], help="comma separated numbers of concurrent requests")
+    concurrency.add_argument("--latency", type=float, default=0.05, help="seconds the mock adds to every request")
+    cycle = sub.add_parser("cycle", help="full copy cycles against the local mock server")
+    cycle.add_argument("--cycles", type=int, default=20, help="cycles per configuration")
+    cycle.add_argument("--symbols", type=int, default=300, help="listed instruments")
+    cycle.add_argument("--positions", type=int_list, default=[5, 20, 50], help="comma separated source book sizes")
+    cycle.add_argument("--followers", type=int_list, default=[1, 4], help="comma separated follower counts")
+    cycle.add_argument("--transports", type=str_list, default=["pooled", "urlopen"], help="pooled, urlopen")
+    cycle.add_argument("--batch-sizes", type=int_list, default=[10, 1], help="comma separated batchorder sizes, 1 sends orders one by one")
+    cycle.add_argument("--snapshots", type=str_list, default=["concurrent"], help="concurrent, sequential")
+    cycle.add_argument("--orders", type=str_list, default=["reconcile"], help="reconcile (keep and amend open orders), replace (cancel all and resend)")
+    cycle.add_argument("--volatility", type=float, default=0, help="relative mark price move between cycles, makes resting orders stale")
+    cycle.add_argument("--latency", type=float, default=0.02, help="seconds the mock adds to every request")
+    cycle.add_argument("--connect-latency", type=float, default=0.03, help="seconds the mock adds to every new connection, like a TLS handshake")
+    args = parser.parse_args()
+
+    if args.benchmark == "cycle":
+        bench_cycle(args)
+    elif args.benchmark == "signing":
+        bench_signing(args.seconds)
+    elif args.benchmark == "concurrency":
+        for inFlight in args.in_flight:
+            bench_concurrency(args.requests, inFlight, args.latency)
+    elif args.benchmark == "decode":
+        bench_decode(args.seconds, args.symbols)
+    elif args.benchmark == "plan":
+        bench_plan(args.seconds, args.symbols, args.positions)
+
+if __name__ == "__main__":
+    main()
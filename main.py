@@ -38,28 +38,549 @@ import urllib.request as urllib2
 import urllib.parse as urllib
 import ssl
 import math
+import io
+import http.client
+import threading
+import heapq
+import select
+import typing
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+# optional faster JSON decoders, the standard library is used when neither is installed
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# response of a pooled request; the body is read eagerly so the connection can be reused
+class cfResponse(object):
+    def __init__(self, url, status, reason, headers, body, retries=0, connects=0):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.retries = retries  # times the request was sent again on a fresh connection
+        self.connects = connects  # new connections (TCP and TLS handshakes) this request needed
+
+    def read(self):
+        return self.body
+
+    def getcode(self):
+        return self.status
+
+# field-projected response schemas: decoding with one of these keeps only the listed fields
+class cfTicker(typing.TypedDict, total=False):
+    symbol: str
+    markPrice: typing.Optional[float]
+
+class cfTickersResponse(typing.TypedDict, total=False):
+    result: str
+    error: str
+    serverTime: str
+    tickers: typing.List[cfTicker]
+
+class cfInstrument(typing.TypedDict, total=False):
+    symbol: str
+    tickSize: typing.Optional[float]
+    contractValueTradePrecision: typing.Optional[int]
+
+class cfInstrumentsResponse(typing.TypedDict, total=False):
+    result: str
+    error: str
+    serverTime: str
+    instruments: typing.List[cfInstrument]
+
+class cfPosition(typing.TypedDict, total=False):
+    symbol: str
+    side: str
+    size: float
+    price: float
+    fillTime: str
+
+class cfOpenPositionsResponse(typing.TypedDict, total=False):
+    result: str
+    error: str
+    serverTime: str
+    openPositions: typing.List[cfPosition]
+
+# builds a function that keeps only the fields of a TypedDict schema, recursing into lists; None for plain values
+def cfProjector(schema):
+    if typing.get_origin(schema) is list:
+        item = cfProjector(typing.get_args(schema)[0])
+        if item is None:
+            return None
+        return lambda obj: [ item(o) for o in obj ] if isinstance(obj, list) else obj
+    if not typing.is_typeddict(schema):
+        return None
+    nested = {}
+    for k, fieldSchema in typing.get_type_hints(schema).items():
+        nested[k] = cfProjector(fieldSchema)
+    plain = tuple( k for k, p in nested.items() if p is None )
+    nested = { k: p for k, p in nested.items() if p is not None }
+
+    # looks up the few schema fields instead of walking every field of the response
+    def project(obj):
+        if not isinstance(obj, dict):
+            return obj
+        projected = { k: obj[k] for k in plain if k in obj }
+        for k, p in nested.items():
+            if k in obj:
+                projected[k] = p(obj[k])
+        return projected
+    return project
+
+# decodes response bodies straight from bytes with msgspec, orjson or the standard library, whichever is available.
+# With a schema, msgspec skips the other fields while parsing; the other backends parse everything and drop them afterwards.
+class cfJsonDecoder(object):
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = "msgspec" if msgspec is not None else "orjson" if orjson is not None else "json"
+        self.backend = backend
+        self.typedDecoders = {}  # msgspec decoder or projector per schema, built once
+
+    def decode(self, data, schema=None):
+        if self.backend == "msgspec":
+            try:
+                if schema is None:
+                    return msgspec.json.decode(data)
+                decoder = self.typedDecoders.get(schema)
+                if decoder is None:
+                    decoder = self.typedDecoders[schema] = msgspec.json.Decoder(schema, strict=False)
+                return decoder.decode(data)
+            except msgspec.DecodeError as e:
+                raise ValueError(str(e)) from e  # like the other backends
+        obj = orjson.loads(data) if self.backend == "orjson" else json.loads(data)
+        if schema is None:
+            return obj
+        project = self.typedDecoders.get(schema)
+        if project is None:
+            project = self.typedDecoders[schema] = cfProjector(schema)
+        return project(obj)
+
+cfDefaultDecoder = cfJsonDecoder()
+
+# keeps keep-alive HTTP(S) connections open per host so consecutive requests skip the TCP and TLS handshakes
+class cfConnectionPool(object):
+    # methods that may be sent again when a reused connection turns out to be closed; an order request the server
+    # may already have executed is never repeated
+    retryMethods = ("GET", "HEAD")
+
+    def __init__(self, maxSize=4, idleTimeout=30):
+        self.maxSize = maxSize  # max connections per host
+        self.idleTimeout = idleTimeout  # seconds an unused connection is kept open
+        self._idle = {}  # key -> [(connection, lastUsed)]
+        self._open = {}  # key -> number of open connections (idle + in use)
+        self._sslContexts = {}
+        self._cond = threading.Condition()
+
+    # builds the SSL context once per certificate mode instead of once per request
+    def _get_ssl_context(self, checkCertificate):
+        ctx = self._sslContexts.get(checkCertificate)
+        if ctx is None:
+            ctx = ssl.create_default_context()
+            if not checkCertificate:
+                ctx.check_hostname = False
+                ctx.verify_mode = ssl.CERT_NONE
+            self._sslContexts[checkCertificate] = ctx
+        return ctx
+
+    def _new_connection(self, key, timeout):
+        scheme, host, port, checkCertificate = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=timeout, context=self._get_ssl_context(checkCertificate))
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    # closes idle connections that have not been used for idleTimeout seconds, lock must be held
+    def _evict_idle(self, now):
+        for key, idle in self._idle.items():
+            while idle and now - idle[0][1] > self.idleTimeout:
+                conn, _ = idle.pop(0)
+                conn.close()
+                self._open[key] -= 1
+
+    # returns (connection, reused)
+    def _acquire(self, key, timeout):
+        with self._cond:
+            while True:
+                self._evict_idle(time.monotonic())
+                idle = self._idle.get(key)
+                if idle:
+                    conn, _ = idle.pop()
+                    if conn.sock is None or select.select([conn.sock], [], [], 0)[0]:
+                        # closed by the server while idle (readable means EOF here), don't send a request on it
+                        conn.close()
+                        self._open[key] -= 1
+                        continue
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                if self._open.get(key, 0) < self.maxSize:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                self._cond.wait()
+        try:
+            return self._new_connection(key, timeout), False
+        except Exception:
+            self._discard(key, None)
+            raise
+
+    def _release(self, key, conn):
+        with self._cond:
+            self._idle.setdefault(key, []).append((conn, time.monotonic()))
+            self._cond.notify()
+
+    def _discard(self, key, conn):
+        if conn is not None:
+            conn.close()
+        with self._cond:
+            self._open[key] -= 1
+            self._cond.notify()
+
+    # sends a request over a pooled connection and returns a cfResponse, raises HTTPError on 4xx/5xx like urlopen
+    def request(self, method, url, body=None, headers=None, timeout=10, checkCertificate=True):
+        parsed = urllib.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port, checkCertificate)
+        path = parsed.path + ("?" + parsed.query if parsed.query else "")
+
+        retries = 0
+        connects = 0
+        while True:
+            conn, reused = self._acquire(key, timeout)
+            if not reused:
+                connects += 1
+            sent = responded = False
+            try:
+                conn.request(method, path, body=body, headers=headers or {})
+                sent = True
+                response = conn.getresponse()
+                responded = True
+                data = response.read()
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # the server closed a keep-alive connection: reconnect and send again, unless the request may have been executed
+                self._discard(key, conn)
+                if reused and not responded and (not sent or method in self.retryMethods):
+                    retries += 1
+                    continue
+                raise
+            except Exception:
+                self._discard(key, conn)
+                raise
+            break
+
+        if response.will_close:
+            self._discard(key, conn)
+        else:
+            self._release(key, conn)
+
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(data))
+        return cfResponse(url, response.status, response.reason, response.headers, data, retries, connects)
+
+    # closes all idle connections
+    def close(self):
+        with self._cond:
+            for key, idle in self._idle.items():
+                for conn, _ in idle:
+                    conn.close()
+                self._open[key] -= len(idle)
+            self._idle = {}
+
+# the same pooling for coroutines: a minimal HTTP/1.1 client on asyncio streams, so many requests can be in flight on one
+# thread. Requests beyond maxSize open connections per host wait for a free one; a request that times out or is
+# cancelled closes its connection, since the rest of the response may still arrive on it.
+class cfAsyncConnectionPool(object):
+    def __init__(self, maxSize=100, idleTimeout=30):
+        self.maxSize = maxSize  # max connections per host
+        self.idleTimeout = idleTimeout  # seconds an unused connection is kept open
+        self._idle = {}  # key -> [(reader, writer, lastUsed)]
+        self._slots = {}  # key -> asyncio.Semaphore of maxSize
+        self._sslContexts = {}
+
+    _get_ssl_context = cfConnectionPool._get_ssl_context
+
+    def _take_idle(self, key):
+        idle = self._idle.get(key, [])
+        now = time.monotonic()
+        while idle:
+            reader, writer, lastUsed = idle.pop()
+            if now - lastUsed <= self.idleTimeout and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        return None
+
+    # reads the rest of a response after its status line
+    async def _read_response(self, reader, statusLine):
+        version, status, reason = (statusLine.decode("latin-1").rstrip("\r\n").split(" ", 2) + [""])[:3]
+        status = int(status)
+        headerLines = []
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            headerLines.append(line)
+        headers = http.client.parse_headers(io.BytesIO(b"".join(headerLines) + b"\r\n"))
+        keepAlive = version == "HTTP/1.1" and (headers.get("Connection") or "").lower() != "close"
+
+        if status in (204, 304) or 100 <= status < 200:
+            data = b""
+        elif "chunked" in (headers.get("Transfer-Encoding") or "").lower():
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass  # trailers
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            data = b"".join(chunks)
+        elif headers.get("Content-Length") is not None:
+            data = await reader.readexactly(int(headers["Content-Length"]))
+        else:
+            data = await reader.read()
+            keepAlive = False
+        return status, reason, headers, data, keepAlive
+
+    async def _exchange(self, key, method, url, path, body, headers, retries, connects):
+        scheme, host, port, checkCertificate = key
+        while True:
+            conn = self._take_idle(key)
+            reused = conn is not None
+            if conn is None:
+                sslContext = self._get_ssl_context(checkCertificate) if scheme == "https" else None
+                conn = await asyncio.open_connection(host, port or (443 if scheme == "https" else 80), ssl=sslContext)
+                connects += 1
+            reader, writer = conn
+            sent = responded = False
+            try:
+                head = "%s %s HTTP/1.1\r\nHost: %s\r\nContent-Length: %d\r\n" % (method, path, host if port is None else "%s:%d" % (host, port), len(body))
+                head += "".join("%s: %s\r\n" % (k, v.decode() if isinstance(v, bytes) else v) for k, v in (headers or {}).items())
+                writer.write(head.encode("latin-1") + b"\r\n" + body)
+                await writer.drain()
+                sent = True
+                statusLine = await reader.readline()
+                if not statusLine:
+                    raise ConnectionResetError("connection closed by the server")
+                responded = True
+                status, reason, responseHeaders, data, keepAlive = await self._read_response(reader, statusLine)
+            except (ConnectionResetError, BrokenPipeError):
+                # like cfConnectionPool: reconnect and send again, unless the request may have been executed
+                writer.close()
+                if reused and not responded and (not sent or method in cfConnectionPool.retryMethods):
+                    retries += 1
+                    continue
+                raise
+            except BaseException:
+                writer.close()
+                raise
+            break
+
+        if keepAlive:
+            self._idle.setdefault(key, []).append((reader, writer, time.monotonic()))
+        else:
+            writer.close()
+        return cfResponse(url, status, reason, responseHeaders, data, retries, connects)
+
+    # sends a request over a pooled connection and returns a cfResponse, raises HTTPError on 4xx/5xx like urlopen
+    async def request(self, method, url, body=None, headers=None, timeout=10, checkCertificate=True):
+        parsed = urllib.urlsplit(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port, checkCertificate)
+        path = parsed.path + ("?" + parsed.query if parsed.query else "")
+        slots = self._slots.get(key)
+        if slots is None:
+            slots = self._slots[key] = asyncio.Semaphore(self.maxSize)
+
+        async with slots:
+            response = await asyncio.wait_for(self._exchange(key, method, url, path, body or b"", headers, 0, 0), timeout)
+        if response.status >= 400:
+            raise urllib2.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(response.body))
+        return response
+
+    # closes all idle connections
+    def close(self):
+        for idle in self._idle.values():
+            for reader, writer, lastUsed in idle:
+                writer.close()
+        self._idle = {}
+
+# token bucket that hands out tokens to waiting requests in priority order (lower first, then first come first served)
+class cfTokenBucket(object):
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate  # tokens per second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blockedUntil = 0  # set after a throttle response
+        self.backoff = 0
+        self.waiters = []  # heap of (priority, sequence, cost)
+        self.sequence = 0
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # blocks until `cost` tokens are available and it is this request's turn, returns the seconds waited
+    def acquire(self, cost, priority):
+        with self.cond:
+            self.sequence += 1
+            entry = (priority, self.sequence, cost)
+            heapq.heappush(self.waiters, entry)
+            start = time.monotonic()
+            try:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    needed = min(cost, self.capacity)  # a request costing more than the capacity may overdraw a full bucket
+                    if self.waiters[0] != entry:
+                        self.cond.wait()
+                    elif now < self.blockedUntil or self.tokens < needed:
+                        self.cond.wait(max(self.blockedUntil - now, (needed - self.tokens) / self.rate, 0.001))
+                    else:
+                        self.tokens -= cost
+                        return now - start
+            finally:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+    # like acquire, for coroutines: sleeps on the event loop instead of blocking a thread
+    async def acquire_async(self, cost, priority):
+        with self.cond:
+            self.sequence += 1
+            entry = (priority, self.sequence, cost)
+            heapq.heappush(self.waiters, entry)
+        start = time.monotonic()
+        try:
+            while True:
+                with self.cond:
+                    now = time.monotonic()
+                    self._refill(now)
+                    # sleep until the request at the head of the queue can go, then look again
+                    needed = min(self.waiters[0][2], self.capacity)
+                    if self.waiters[0] == entry and now >= self.blockedUntil and self.tokens >= needed:
+                        self.tokens -= cost
+                        return now - start
+                    delay = max(self.blockedUntil - now, (needed - self.tokens) / self.rate, 0.001)
+                await asyncio.sleep(delay)
+        finally:
+            with self.cond:
+                self.waiters.remove(entry)
+                heapq.heapify(self.waiters)
+                self.cond.notify_all()
+
+    # the exchange rejected a request for exceeding the limit: empty the bucket and pause, twice as long as last time
+    def throttled(self, maxBackoff):
+        with self.cond:
+            now = time.monotonic()
+            self.backoff = min(max(self.backoff * 2, 1), maxBackoff)
+            self.tokens = 0
+            self.updated = now
+            self.blockedUntil = now + self.backoff
+
+    def succeeded(self):
+        if self.backoff:
+            with self.cond:
+                self.backoff = 0
+
+# client-side budget for the Kraken Futures rate limits, per API key: derivatives endpoints share 500 cost units per 10 seconds,
+# history endpoints 100 per 10 minutes. Requests wait for budget instead of being rejected, order endpoints go first.
+class cfRateLimiter(object):
+    costs = {"sendorder": 10, "editorder": 10, "cancelorder": 10, "cancelallorders": 25, "cancelallordersafter": 25,
+             "withdrawal": 100, "transfer": 10}  # batchorder and fills depend on the request, everything else costs 2
+    orderEndpoints = ("sendorder", "editorder", "cancelorder", "cancelallorders", "cancelallordersafter", "batchorder")
+    publicEndpoints = ("instruments", "tickers", "orderbook", "history")  # limited per IP, not per key
+
+    def __init__(self, capacity=500, window=10, historyCapacity=100, historyWindow=600, maxRetries=5, maxBackoff=30):
+        self.limits = {"derivatives": (capacity, capacity / window), "history": (historyCapacity, historyCapacity / historyWindow)}
+        self.maxRetries = maxRetries  # throttle responses retried per request
+        self.maxBackoff = maxBackoff
+        self.buckets = {}  # (apiKey, limit) -> cfTokenBucket
+        self.lock = threading.Lock()
+
+    # returns (limit, cost, priority) of a request, or None if it is not limited per key
+    def cost(self, endpoint, postUrl="", postBody=""):
+        if endpoint.startswith("/api/history/"):
+            return None if "/market/" in endpoint else ("history", 1, 1)
+        name = endpoint.rsplit("/", 1)[-1]
+        if name in self.publicEndpoints:
+            return None
+        if name == "batchorder":
+            cost = 9 + postBody.count('"order":')
+        elif name == "fills":
+            cost = 2 if "lastFillTime=" in postUrl else 25
+        else:
+            cost = self.costs.get(name, 2)
+        return "derivatives", cost, 0 if name in self.orderEndpoints else 1
+
+    def bucket(self, apiKey, limit):
+        with self.lock:
+            bucket = self.buckets.get((apiKey, limit))
+            if bucket is None:
+                bucket = self.buckets[(apiKey, limit)] = cfTokenBucket(*self.limits[limit])
+            return bucket
+
+    # waits until the request fits in the budget of its API key, returns the seconds waited
+    def acquire(self, apiKey, endpoint, postUrl="", postBody=""):
+        c = self.cost(endpoint, postUrl, postBody)
+        if c is None:
+            return 0
+        limit, cost, priority = c
+        return self.bucket(apiKey, limit).acquire(cost, priority)
+
+    async def acquire_async(self, apiKey, endpoint, postUrl="", postBody=""):
+        c = self.cost(endpoint, postUrl, postBody)
+        if c is None:
+            return 0
+        limit, cost, priority = c
+        return await self.bucket(apiKey, limit).acquire_async(cost, priority)
+
+    def throttled(self, apiKey, endpoint):
+        c = self.cost(endpoint)
+        self.bucket(apiKey, c[0] if c is not None else "derivatives").throttled(self.maxBackoff)
+
+    def succeeded(self, apiKey, endpoint):
+        c = self.cost(endpoint)
+        if c is not None:
+            self.bucket(apiKey, c[0]).succeeded()
 
 class cfApiMethods(object):
-    def __init__(self, apiPath, apiPublicKey="", apiPrivateKey="", timeout=10, checkCertificate=True, useNonce=False):
+    def __init__(self, apiPath, apiPublicKey="", apiPrivateKey="", timeout=10, checkCertificate=True, useNonce=False, pool=None, metrics=None, rateLimiter=None, decoder=None, projectFields=False):
         self.apiPath = apiPath
         self.apiPublicKey = apiPublicKey
         self.apiPrivateKey = apiPrivateKey
         self.timeout = timeout
         self.nonce = 0
+        self.nonceLock = threading.Lock()
         self.checkCertificate = checkCertificate
         self.useNonce = useNonce
+        self.pool = pool if pool is not None else cfConnectionPool()  # share one pool between clients to reuse connections
+        self.metrics = metrics  # optional, gets record_request(endpoint, seconds, status, size, retries, connects) for every request
+        self.rateLimiter = rateLimiter  # optional cfRateLimiter, share one between clients
+        self.decoder = decoder if decoder is not None else cfDefaultDecoder
+        self.projectFields = projectFields  # decode tickers, instruments and positions with only the fields of their schema
+
+        # the decoded secret and its HMAC-SHA512 key schedule are the same for every request, build them once and copy per request
+        self.hmacPrototype = hmac.new(base64.b64decode(apiPrivateKey), digestmod=hashlib.sha512)
 
     ##### public endpoints #####
 
     # returns all instruments with specifications
     def get_instruments(self):
         endpoint = "/derivatives/api/v3/instruments"
-        return self.make_request("GET", endpoint)
+        return self.make_request("GET", endpoint, schema=cfInstrumentsResponse if self.projectFields else None)
 
     # returns market data for all instruments
     def get_tickers(self):
         endpoint = "/derivatives/api/v3/tickers"
-        return self.make_request("GET", endpoint)
+        return self.make_request("GET", endpoint, schema=cfTickersResponse if self.projectFields else None)
 
     # returns the entire order book of a futures
     def get_orderbook(self, symbol):
@@ -167,7 +688,7 @@ class cfApiMethods(object):
     # returns all open positions
     def get_openpositions(self):
         endpoint = "/derivatives/api/v3/openpositions"
-        return self.make_request("GET", endpoint)
+        return self.make_request("GET", endpoint, schema=cfOpenPositionsResponse if self.projectFields else None)
 
     # sends an xbt withdrawal request
     def send_withdrawal(self, targetAddress, currency, amount):
@@ -200,7 +721,7 @@ class cfApiMethods(object):
     # accountlog csv
     def get_accountlog(self):
         endpoint = "/api/history/v2/accountlogcsv"
-        return self.make_request("GET", endpoint)
+        return self.make_request_raw("GET", endpoint).read().decode("utf-8")  # CSV, not JSON
 
     def _get_partial_historical_elements(self, elementType, **params):
         endpoint = "/api/history/v2/%s" % elementType
@@ -210,27 +731,41 @@ class cfApiMethods(object):
 
         return self.make_request_raw("GET", endpoint, postUrl)
 
-    def _get_historical_elements(self, elementType, since=None, before=None, sort=None, limit=1000):
-        elements = []
-
-        continuationToken = None
-
-        while True:
-            res = self._get_partial_historical_elements(elementType, since = since, before = before, sort = sort, continuationToken = continuationToken)
-            body = json.loads(res.read().decode('utf-8'))
-            elements = elements + body['elements']
-
-            if res.headers['is-truncated'] is None or res.headers['is-truncated'] == "false":
-                continuationToken = None
-                break
-            else:
-                continuationToken = res.headers['next-continuation-token']
+    # yields elements page by page, fetching the next page in the background while the current one is consumed
+    def _iter_historical_elements(self, elementType, since=None, before=None, sort=None, limit=None, prefetch=True):
+        def fetch(continuationToken):
+            return self._get_partial_historical_elements(elementType, since = since, before = before, sort = sort, continuationToken = continuationToken)
+
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        count = 0
+        nextPage = None
+        try:
+            res = fetch(None)
+            while True:
+                elements = self.decoder.decode(res.read())['elements']
+                if limit is not None:
+                    elements = elements[:limit - count]
+                count += len(elements)
+
+                # only ask for the next page if it is needed, so a limit never fetches more than necessary
+                nextPage = None
+                if res.headers['is-truncated'] is not None and res.headers['is-truncated'] != "false" and (limit is None or count < limit):
+                    continuationToken = res.headers['next-continuation-token']
+                    nextPage = executor.submit(fetch, continuationToken) if executor is not None else continuationToken
+
+                yield from elements
+
+                if nextPage is None:
+                    return
+                res = nextPage.result() if executor is not None else fetch(nextPage)
+                nextPage = None
+        finally:
+            if executor is not None:
+                # the consumer stopped early: drop the pending page if its request has not gone out yet
+                executor.shutdown(wait=False, cancel_futures=True)
 
-            if len(elements) >= limit:
-                elements = elements[:limit]
-                break
-
-        return elements
+    def _get_historical_elements(self, elementType, since=None, before=None, sort=None, limit=1000):
+        return list(self._iter_historical_elements(elementType, since, before, sort, limit))
 
     def get_orders(self, since=None, before=None, sort=None, limit=1000):
         """
@@ -300,6 +835,79 @@ class cfApiMethods(object):
 
         return self._get_historical_elements('market/' + symbol + '/executions', since, before, sort, limit)
 
+    def iter_orders(self, since=None, before=None, sort=None, limit=None, prefetch=True):
+        """
+        Iterates over orders of your account, page by page. The next page is fetched in the background while the current one is consumed.
+
+        :param since: Timestamp in milliseconds. Retrieves orders starting at this time rather than the newest/latest.
+        :param before: Timestamp in milliseconds. Retrieves orders before this time.
+        :param sort: String "asc" or "desc". The sorting of orders.
+        :param limit: Maximum amount of orders to be retrieved, None for all.
+        :param prefetch: Fetch the next page in the background. Pass False when stopping early, so no page beyond the last one consumed is requested.
+        :return: Generator of orders
+        """
+
+        return self._iter_historical_elements('orders', since, before, sort, limit, prefetch)
+
+    def iter_executions(self, since=None, before=None, sort=None, limit=None, prefetch=True):
+        """
+        Iterates over executions of your account, page by page. The next page is fetched in the background while the current one is consumed.
+
+        :param since: Timestamp in milliseconds. Retrieves executions starting at this time rather than the newest/latest.
+        :param before: Timestamp in milliseconds. Retrieves executions before this time.
+        :param sort: String "asc" or "desc". The sorting of executions.
+        :param limit: Maximum amount of executions to be retrieved, None for all.
+        :param prefetch: Fetch the next page in the background. Pass False when stopping early, so no page beyond the last one consumed is requested.
+        :return: Generator of executions
+        """
+
+        return self._iter_historical_elements('executions', since, before, sort, limit, prefetch)
+
+    def iter_market_price(self, symbol, since=None, before=None, sort=None, limit=None, prefetch=True):
+        """
+        Iterates over prices of given symbol, page by page. The next page is fetched in the background while the current one is consumed.
+
+        :param symbol: Name of a symbol. For example "PI_XBTUSD".
+        :param since: Timestamp in milliseconds. Retrieves prices starting at this time rather than the newest/latest.
+        :param before: Timestamp in milliseconds. Retrieves prices before this time.
+        :param sort: String "asc" or "desc". The sorting of prices.
+        :param limit: Maximum amount of prices to be retrieved, None for all.
+        :param prefetch: Fetch the next page in the background. Pass False when stopping early, so no page beyond the last one consumed is requested.
+        :return: Generator of prices
+        """
+
+        return self._iter_historical_elements('market/' + symbol + '/price', since, before, sort, limit, prefetch)
+
+    def iter_market_orders(self, symbol, since=None, before=None, sort=None, limit=None, prefetch=True):
+        """
+        Iterates over orders of given symbol, page by page. The next page is fetched in the background while the current one is consumed.
+
+        :param symbol: Name of a symbol. For example "PI_XBTUSD".
+        :param since: Timestamp in milliseconds. Retrieves orders starting at this time rather than the newest/latest.
+        :param before: Timestamp in milliseconds. Retrieves orders before this time.
+        :param sort: String "asc" or "desc". The sorting of orders.
+        :param limit: Maximum amount of orders to be retrieved, None for all.
+        :param prefetch: Fetch the next page in the background. Pass False when stopping early, so no page beyond the last one consumed is requested.
+        :return: Generator of orders
+        """
+
+        return self._iter_historical_elements('market/' + symbol + '/orders', since, before, sort, limit, prefetch)
+
+    def iter_market_executions(self, symbol, since=None, before=None, sort=None, limit=None, prefetch=True):
+        """
+        Iterates over executions of given symbol, page by page. The next page is fetched in the background while the current one is consumed.
+
+        :param symbol: Name of a symbol. For example "PI_XBTUSD".
+        :param since: Timestamp in milliseconds. Retrieves executions starting at this time rather than the newest/latest.
+        :param before: Timestamp in milliseconds. Retrieves executions before this time.
+        :param sort: String "asc" or "desc". The sorting of executions.
+        :param limit: Maximum amount of executions to be retrieved, None for all.
+        :param prefetch: Fetch the next page in the background. Pass False when stopping early, so no page beyond the last one consumed is requested.
+        :return: Generator of executions
+        """
+
+        return self._iter_historical_elements('market/' + symbol + '/executions', since, before, sort, limit, prefetch)
+
     # signs a message
     def sign_message(self, endpoint, postData, nonce=""):
         if endpoint.startswith('/derivatives'):
@@ -309,31 +917,25 @@ class cfApiMethods(object):
         message = postData + nonce + endpoint
 
         # step 2: hash the result of step 1 with SHA256
-        sha256_hash = hashlib.sha256()
-        sha256_hash.update(message.encode('utf8'))
-        hash_digest = sha256_hash.digest()
-
-        # step 3: base64 decode apiPrivateKey
-        secretDecoded = base64.b64decode(self.apiPrivateKey)
+        hash_digest = hashlib.sha256(message.encode('utf8')).digest()
 
-        # step 4: use result of step 3 to has the result of step 2 with HMAC-SHA512
-        hmac_digest = hmac.new(secretDecoded, hash_digest,
-                               hashlib.sha512).digest()
+        # step 3 and 4: hash the result of step 2 with HMAC-SHA512, keyed with the base64 decoded apiPrivateKey (decoded in __init__)
+        hmac_hash = self.hmacPrototype.copy()
+        hmac_hash.update(hash_digest)
+        hmac_digest = hmac_hash.digest()
 
         # step 5: base64 encode the result of step 4 and return
         return base64.b64encode(hmac_digest)
 
-    # creates a unique nonce
+    # creates a unique, strictly increasing nonce, also when called from several threads
     def get_nonce(self):
-        # https://en.wikipedia.org/wiki/Modulo_operation
-        self.nonce = (self.nonce + 1) & 8191
-        return str(int(time.time() * 1000)) + str(self.nonce).zfill(4)
-
-    # sends an HTTP request
-    def make_request_raw(self, requestType, endpoint, postUrl="", postBody=""):
-        # create authentication headers
-        postData = postUrl + postBody
+        # milliseconds followed by 4 counter digits; more than 10000 nonces in one millisecond borrow from the next millisecond
+        with self.nonceLock:
+            self.nonce = max(int(time.time() * 1000) * 10000, self.nonce + 1)
+            return str(self.nonce)
 
+    # authentication and content headers of one request
+    def authent_headers(self, endpoint, postData):
         if self.useNonce:
             nonce = self.get_nonce()
             signature = self.sign_message(endpoint, postData, nonce=nonce)
@@ -345,6 +947,12 @@ class cfApiMethods(object):
                 "APIKey": self.apiPublicKey, "Authent": signature}
 
         authentHeaders["User-Agent"] = "cf-api-python/1.0"
+        authentHeaders["Content-Type"] = "application/x-www-form-urlencoded"
+        return authentHeaders
+
+    # sends an HTTP request
+    def make_request_raw(self, requestType, endpoint, postUrl="", postBody=""):
+        postData = postUrl + postBody
 
         # create request
         if postUrl != "":
@@ -352,25 +960,179 @@ class cfApiMethods(object):
         else:
             url = self.apiPath + endpoint
 
-        request = urllib2.Request(url, str.encode(postBody), authentHeaders)
-        request.get_method = lambda: requestType
+        start = time.perf_counter()
+        throttles = 0
+        while True:
+            # wait for API budget, order placement goes before informational calls
+            if self.rateLimiter is not None:
+                self.rateLimiter.acquire(self.apiPublicKey, endpoint, postUrl, postBody)
+
+            # create authentication headers, with a fresh nonce when the request is sent again
+            authentHeaders = self.authent_headers(endpoint, postData)
+
+            # send request over a pooled keep-alive connection and read response
+            try:
+                response = self.pool.request(requestType, url, str.encode(postBody), authentHeaders,
+                                             timeout=self.timeout, checkCertificate=self.checkCertificate)
+            except urllib2.HTTPError as e:
+                # throttled: back off and send again, the request was not executed
+                if e.code == 429 and self.rateLimiter is not None and throttles < self.rateLimiter.maxRetries:
+                    self.rateLimiter.throttled(self.apiPublicKey, endpoint)
+                    throttles += 1
+                    continue
+                if self.metrics is not None:
+                    self.metrics.record_request(endpoint, time.perf_counter() - start, e.code, 0, throttles, 0)
+                raise
+            except Exception:
+                if self.metrics is not None:
+                    self.metrics.record_request(endpoint, time.perf_counter() - start, "error", 0, throttles, 0)
+                raise
+
+            if self.rateLimiter is not None:
+                if b"apiLimitExceeded" in response.body and throttles < self.rateLimiter.maxRetries:
+                    self.rateLimiter.throttled(self.apiPublicKey, endpoint)
+                    throttles += 1
+                    continue
+                self.rateLimiter.succeeded(self.apiPublicKey, endpoint)
+            break
+
+        response.retries += throttles
+        if self.metrics is not None:
+            self.metrics.record_request(endpoint, time.perf_counter() - start, response.status, len(response.body), response.retries, response.connects)
+
+        # return
+        return response
+
+    # sends an HTTP request and returns the decoded JSON response, with only the fields of `schema` if one is given
+    def make_request(self, requestType, endpoint, postUrl="", postBody="", schema=None):
+        return self.decoder.decode(self.make_request_raw(requestType, endpoint, postUrl, postBody).read(), schema)
+
+# cfApiMethods for asyncio: every endpoint method returns an awaitable and the iter_ methods are async generators,
+# with the same signing, nonces, rate limiting and metrics. Many requests share one thread and a cfAsyncConnectionPool.
+#
+#   client = AsyncCfApiMethods(apiPath, apiPublicKey, apiPrivateKey)
+#   tickers, books = await asyncio.gather(client.get_tickers(), client.batch(client.get_orderbook(s) for s in symbols))
+class AsyncCfApiMethods(cfApiMethods):
+    def __init__(self, apiPath, apiPublicKey="", apiPrivateKey="", timeout=10, checkCertificate=True, useNonce=False, pool=None, metrics=None, rateLimiter=None, decoder=None, projectFields=False):
+        super().__init__(apiPath, apiPublicKey, apiPrivateKey, timeout, checkCertificate, useNonce,
+                         pool if pool is not None else cfAsyncConnectionPool(), metrics, rateLimiter, decoder, projectFields)
 
-        # read response
-        if self.checkCertificate:
-            response = urllib2.urlopen(request, timeout=self.timeout)
+    # accountlog csv
+    async def get_accountlog(self):
+        endpoint = "/api/history/v2/accountlogcsv"
+        return (await self.make_request_raw("GET", endpoint)).read().decode("utf-8")  # CSV, not JSON
+
+    # yields elements page by page, fetching the next page in the background while the current one is consumed
+    async def _iter_historical_elements(self, elementType, since=None, before=None, sort=None, limit=None, prefetch=True):
+        def fetch(continuationToken):
+            return self._get_partial_historical_elements(elementType, since = since, before = before, sort = sort, continuationToken = continuationToken)
+
+        count = 0
+        nextPage = None
+        try:
+            res = await fetch(None)
+            while True:
+                elements = self.decoder.decode(res.read())['elements']
+                if limit is not None:
+                    elements = elements[:limit - count]
+                count += len(elements)
+
+                # only ask for the next page if it is needed, so a limit never fetches more than necessary
+                nextPage = None
+                if res.headers['is-truncated'] is not None and res.headers['is-truncated'] != "false" and (limit is None or count < limit):
+                    continuationToken = res.headers['next-continuation-token']
+                    nextPage = asyncio.ensure_future(fetch(continuationToken)) if prefetch else continuationToken
+
+                for element in elements:
+                    yield element
+
+                if nextPage is None:
+                    return
+                res = await nextPage if prefetch else await fetch(nextPage)
+                nextPage = None
+        finally:
+            if prefetch and nextPage is not None:
+                nextPage.cancel()  # the consumer stopped early
+
+    async def _get_historical_elements(self, elementType, since=None, before=None, sort=None, limit=1000):
+        return [ element async for element in self._iter_historical_elements(elementType, since, before, sort, limit) ]
+
+    # sends an HTTP request
+    async def make_request_raw(self, requestType, endpoint, postUrl="", postBody=""):
+        postData = postUrl + postBody
+
+        # create request
+        if postUrl != "":
+            url = self.apiPath + endpoint + "?" + postUrl
         else:
-            ctx = ssl.create_default_context()
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-            response = urllib2.urlopen(
-                request, context=ctx, timeout=self.timeout)
+            url = self.apiPath + endpoint
+
+        start = time.perf_counter()
+        throttles = 0
+        while True:
+            # wait for API budget, order placement goes before informational calls
+            if self.rateLimiter is not None:
+                await self.rateLimiter.acquire_async(self.apiPublicKey, endpoint, postUrl, postBody)
+
+            # create authentication headers, with a fresh nonce when the request is sent again
+            authentHeaders = self.authent_headers(endpoint, postData)
+
+            # send request over a pooled keep-alive connection and read response
+            try:
+                response = await self.pool.request(requestType, url, str.encode(postBody), authentHeaders,
+                                                   timeout=self.timeout, checkCertificate=self.checkCertificate)
+            except urllib2.HTTPError as e:
+                # throttled: back off and send again, the request was not executed
+                if e.code == 429 and self.rateLimiter is not None and throttles < self.rateLimiter.maxRetries:
+                    self.rateLimiter.throttled(self.apiPublicKey, endpoint)
+                    throttles += 1
+                    continue
+                if self.metrics is not None:
+                    self.metrics.record_request(endpoint, time.perf_counter() - start, e.code, 0, throttles, 0)
+                raise
+            except BaseException as e:
+                if self.metrics is not None:
+                    self.metrics.record_request(endpoint, time.perf_counter() - start, "cancelled" if isinstance(e, asyncio.CancelledError) else "error", 0, throttles, 0)
+                raise
+
+            if self.rateLimiter is not None:
+                if b"apiLimitExceeded" in response.body and throttles < self.rateLimiter.maxRetries:
+                    self.rateLimiter.throttled(self.apiPublicKey, endpoint)
+                    throttles += 1
+                    continue
+                self.rateLimiter.succeeded(self.apiPublicKey, endpoint)
+            break
+
+        response.retries += throttles
+        if self.metrics is not None:
+            self.metrics.record_request(endpoint, time.perf_counter() - start, response.status, len(response.body), response.retries, response.connects)
 
         # return
         return response
 
-    # sends an HTTP request and read response body
-    def make_request(self, requestType, endpoint, postUrl="", postBody=""):
-        return self.make_request_raw(requestType, endpoint, postUrl, postBody).read().decode("utf-8")
+    # sends an HTTP request and returns the decoded JSON response, with only the fields of `schema` if one is given
+    async def make_request(self, requestType, endpoint, postUrl="", postBody="", schema=None):
+        return self.decoder.decode((await self.make_request_raw(requestType, endpoint, postUrl, postBody)).read(), schema)
+
+    # runs the awaitables concurrently, at most `limit` at a time, and returns their results in order. Like asyncio.gather,
+    # with return_exceptions failed calls return their exception; without it the first failure, or cancelling the batch,
+    # cancels the calls still running.
+    async def batch(self, calls, limit=None, return_exceptions=False):
+        slots = asyncio.Semaphore(limit) if limit is not None else None
+
+        async def run(call):
+            if slots is None:
+                return await call
+            async with slots:
+                return await call
+
+        tasks = [ asyncio.ensure_future(run(call)) for call in calls ]
+        try:
+            return await asyncio.gather(*tasks, return_exceptions=return_exceptions)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
 
 # SECTION 2
 
@@ -399,121 +1161,1275 @@ class cfApiMethods(object):
 
 import datetime
 import os  # to access "variables" stored in the pipedream context
+import argparse
+import signal
+import contextlib
+import http.server
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # standard settings
 # you could use "api.cryptofacilities.com" if your IP is whitelisted (Settings -> API Keys -> IP Whitelist)
 #apiPath = "https://www.cryptofacilities.com"
-apiPath = "https://futures.kraken.com"
+apiPath = os.environ.get("KRAKEN_API_PATH", "https://futures.kraken.com")  # point at a local mock server for testing
 timeout = 20
 checkCertificate = True  # when using the test environment, this must be set to "False"
 useNonce = False  # nonce is optional
+poolSize = 6  # max keep-alive connections per host, shared by all clients (6 lets the whole snapshot run at once)
+poolIdleTimeout = 30  # seconds before an unused connection is closed
+batchSize = 10  # orders per batchorder request, 1 sends every order on its own
+useRateLimiter = True  # wait for API budget instead of getting "apiLimitExceeded" errors
+jsonDecoder = None  # "msgspec", "orjson" or "json", None uses the fastest one installed
+projectFields = True  # keep only the fields we use of tickers, instruments and positions
+reconcileOrders = True  # keep and amend matching open orders, False cancels all open orders every cycle
+
+# resident mode (--daemon) settings, in seconds
+pollIntervalMin = 2  # poll interval right after a change
+pollIntervalMax = 15  # poll interval after a long quiet period
+resyncInterval = 300  # full cycle at least this often, to follow portfolio value changes and your own fills
+
+cacheDir = os.environ.get("KRAKEN_CACHE_DIR", ".cache")  # local state kept between runs
+
+# instrument specifications rarely change, so they are cached on disk between runs
+instrumentsCachePath = os.path.join(cacheDir, "instruments.json")
+instrumentsCacheTtl = 3600  # seconds before the cache is revalidated in the background
+
+# your positions are kept on disk too and updated from new fills, instead of reading all open positions every cycle
+trackPositions = True
+positionsResyncInterval = 900  # seconds between full reads of your open positions
+fillsPageSize = 100  # fills returned by one get_fills request
+
+# a run stops early when the source positions are the ones copied last time and the portfolio ratios barely moved
+fingerprintPath = os.path.join(cacheDir, "fingerprint.json")
+pfratioDriftThreshold = 0.01  # relative change of your / source portfolio value that counts as unchanged, 0 always rebalances
+
+# after sending, orders that did not fill are repriced towards the top of the order book until they fill or the deadline passes
+chaseDeadline = 30  # seconds to watch the orders, 0 leaves them resting until the next cycle
+chaseInterval = 2  # seconds between status checks
+chaseSlippage = 0.002  # furthest a limit price may move from its planned price, as a fraction of it
+
+# latency histogram with fixed buckets, in seconds
+class Histogram(object):
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float('inf'))
+    __slots__ = ('counts', 'count', 'sum', 'max')
+
+    def __init__(self):
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for n, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[n] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    # upper bound of the bucket holding quantile q, or the max for the last bucket
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'max': self.max,
+        }
+
+# time from sending an order until it filled, in seconds
+class FillHistogram(Histogram):
+    buckets = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 15, 30, 60, 120, 300, float('inf'))
+    __slots__ = ()
+
+# statistics of one endpoint
+class EndpointStats(object):
+    __slots__ = ('latency', 'statuses', 'bytes', 'retries', 'connects')
+
+    def __init__(self):
+        self.latency = Histogram()
+        self.statuses = {}
+        self.bytes = 0
+        self.retries = 0
+        self.connects = 0
+
+# per-endpoint request statistics, recorded by cfApiMethods, cycle phase timings and order fill times
+class Metrics(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}  # endpoint -> EndpointStats
+        self.phases = {}  # phase -> Histogram
+        self.fills = FillHistogram()  # time to fill of every order filled while chasing
+        self.orders = {}  # chase outcome ("filled", "unfilled", "gone") -> orders
+        self.reprices = 0  # limit price edits while chasing
+
+    def record_request(self, endpoint, seconds, status, size, retries, connects):
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = self.endpoints[endpoint] = EndpointStats()
+            stats.latency.observe(seconds)
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            stats.bytes += size
+            stats.retries += retries
+            stats.connects += connects
+
+    def record_phase(self, name, seconds):
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = Histogram()
+            self.phases[name].observe(seconds)
+
+    def record_chase(self, fillTimes, unfilled, gone, reprices):
+        with self.lock:
+            for seconds in fillTimes:
+                self.fills.observe(seconds)
+            for outcome, n in (('filled', len(fillTimes)), ('unfilled', unfilled), ('gone', gone)):
+                self.orders[outcome] = self.orders.get(outcome, 0) + n
+            self.reprices += reprices
+
+    @contextlib.contextmanager
+    def time_phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_phase(name, time.perf_counter() - start)
+
+    def summary(self):
+        with self.lock:
+            return {
+                'endpoints': { endpoint: dict(stats.latency.summary(), statuses={ str(k): v for k, v in stats.statuses.items() },
+                                              bytes=stats.bytes, retries=stats.retries, connects=stats.connects)
+                               for endpoint, stats in self.endpoints.items() },
+                'phases': { name: h.summary() for name, h in self.phases.items() },
+                'fills': dict(self.fills.summary(), orders=dict(self.orders), reprices=self.reprices),
+            }
 
-# check whether all keys are present
-required_env = [
-    "KRAKEN_SOURCE_KEY",
-    "KRAKEN_SOURCE_SECRET",
-    "KRAKEN_YOUR_KEY",
-    "KRAKEN_YOUR_SECRET",
-]
-missing = [k for k in required_env if k not in os.environ]
-if missing:
-    raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
-
-# removed "cfApi." before these methods:
-cfPublic = cfApiMethods(apiPath, timeout=timeout, checkCertificate=checkCertificate)
-cfSource = cfApiMethods(apiPath, timeout=timeout, apiPublicKey=os.environ["KRAKEN_SOURCE_KEY"], apiPrivateKey=os.environ["KRAKEN_SOURCE_SECRET"], checkCertificate=checkCertificate, useNonce=useNonce)
-cfYour = cfApiMethods(apiPath, timeout=timeout, apiPublicKey=os.environ["KRAKEN_YOUR_KEY"], apiPrivateKey=os.environ["KRAKEN_YOUR_SECRET"], checkCertificate=checkCertificate, useNonce=useNonce)
-
-# get general info about assets
-instruments = json.loads(cfPublic.get_instruments())['instruments']
-#print( [ i for i in instruments if i['symbol'] == 'PF_XBTUSD' ], '\n')
-
-# get futures portfolio value ratio (including unrealized PnL)
-source_portfolio_value = json.loads(cfSource.get_accounts())['accounts']['flex']['portfolioValue']
-your_portfolio = json.loads(cfYour.get_accounts())
-#print(your_portfolio,'\n')  
-your_portfolio_value = your_portfolio['accounts']['flex']['portfolioValue']
-print('your_portfolio_value:', your_portfolio_value, 'USD\n')
-
-if your_portfolio_value <= 100:  # stop if your account is almost empty (which would cause strategy to behave irregularly)
-    raise ValueError('Your account has < 100 USD value, causing strategy to become irregular or unreliable.')
-
-# get current futures positions
-source_positions = json.loads(cfSource.get_openpositions())['openPositions']
-your_positions = json.loads(cfYour.get_openpositions())['openPositions']
-#print( source_positions )
-
-# get current prices (if script runs quickly, assume prices are still roughly the same)
-tickers = json.loads(cfPublic.get_tickers())['tickers']
-
-# adjust your portfolio to resemble source portfolio.
-if source_portfolio_value <= 500:  # avoid division by zero, and also stop if source account is almost empty (which would cause strategy to behave irregularly)
-    raise ValueError('The SOURCE account has < 500 USD value, causing strategy to become irregular or unreliable.')    
-else:
-    pfratio = your_portfolio_value / source_portfolio_value
-  
-    # close all open orders
-    result = json.loads(cfYour.cancel_all_orders())
-    if len(result['cancelStatus']['cancelledOrders']) > 0:
-        print('cancel_all_orders:\n', result['result'], 'cancelled', len(result['cancelStatus']['cancelledOrders']), 'orders.\n' )
-    
-    # close any of your positions that no longer appear in source positions list
-    for your_pos in your_positions: 
-        s = your_pos['symbol']
-        if len( [ p for p in source_positions if p['symbol'] == s ] ) == 0:    # if corresponding source position not found
-            # send limit order to close it
-            contractValueTradePrecision = [ i['contractValueTradePrecision'] for i in instruments if i['symbol'] == s ][0]
-            position_adjustment = round( -1 * your_pos['size'], contractValueTradePrecision )  # avoid "sendStatus":{"status":"invalidSize"} issue    
-            if abs( position_adjustment ) > 0:
-                markPrice = [ t['markPrice'] for t in tickers if t['symbol'] == s ][0]
-                # price must have correct precision (different from contractValueTradePrecision) avoid "sendStatus":{"status":"invalidPrice"} issue
-                tickSize = [ i['tickSize'] for i in instruments if i['symbol'] == s ][0]
-                if position_adjustment > 0:
-                    limitPrice = math.ceil( markPrice / tickSize ) * tickSize
-                else:
-                    limitPrice = math.floor( markPrice / tickSize ) * tickSize
-                limit_order = { 
+    # Prometheus text exposition format
+    def prometheus(self):
+        lines = []
+        def histogram(name, label, values):
+            lines.append('# TYPE %s histogram' % name)
+            for value, h in values:
+                cumulative = 0
+                for bound, n in zip(h.buckets, h.counts):
+                    cumulative += n
+                    lines.append('%s_bucket{%s="%s",le="%s"} %d' % (name, label, value, '+Inf' if bound == float('inf') else bound, cumulative))
+                lines.append('%s_sum{%s="%s"} %f' % (name, label, value, h.sum))
+                lines.append('%s_count{%s="%s"} %d' % (name, label, value, h.count))
+        def counter(name, values):
+            lines.append('# TYPE %s counter' % name)
+            lines.extend('%s{%s} %d' % (name, labels, n) if labels else '%s %d' % (name, n) for labels, n in values)
+
+        with self.lock:
+            endpoints = sorted(self.endpoints.items())
+            histogram('copytrader_request_duration_seconds', 'endpoint', [ (e, stats.latency) for e, stats in endpoints ])
+            counter('copytrader_requests_total', [ ('endpoint="%s",status="%s"' % (e, status), n) for e, stats in endpoints for status, n in stats.statuses.items() ])
+            counter('copytrader_response_bytes_total', [ ('endpoint="%s"' % e, stats.bytes) for e, stats in endpoints ])
+            counter('copytrader_request_retries_total', [ ('endpoint="%s"' % e, stats.retries) for e, stats in endpoints ])
+            counter('copytrader_connections_opened_total', [ ('endpoint="%s"' % e, stats.connects) for e, stats in endpoints ])
+            histogram('copytrader_phase_duration_seconds', 'phase', sorted(self.phases.items()))
+            histogram('copytrader_order_fill_seconds', 'stage', [ ('chase', self.fills) ])
+            counter('copytrader_chased_orders_total', [ ('outcome="%s"' % outcome, n) for outcome, n in sorted(self.orders.items()) ])
+            counter('copytrader_order_reprices_total', [ ('', self.reprices) ])
+        return '\n'.join(lines) + '\n'
+
+# times a cycle phase, does nothing when metrics are off
+def phase(metrics, name):
+    return metrics.time_phase(name) if metrics is not None else contextlib.nullcontext()
+
+# serves the metrics at http://host:port/metrics from a background thread
+def serve_metrics(metrics, port, host="127.0.0.1"):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.prometheus().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
+
+# everything a copy cycle reads from the exchange, taken at (nearly) the same moment
+class Snapshot(object):
+    def __init__(self, instruments, tickers, source_accounts, your_accounts, source_positions, your_positions, timings, elapsed, market=None, source_book=None):
+        self.instruments = instruments
+        self.tickers = tickers
+        self.source_accounts = source_accounts
+        self.your_accounts = your_accounts
+        self.source_positions = source_positions
+        self.your_positions = your_positions
+        self.timings = timings  # seconds per call
+        self.elapsed = elapsed  # seconds for the whole snapshot, roughly the slowest call
+        # the market index and source book can be shared between the snapshots of several followers
+        self.market = market if market is not None else MarketIndex(instruments, tickers)
+        self.source_book = source_book if source_book is not None else index_positions(source_positions)
+        self.your_book = index_positions(your_positions)
+
+    # replaces the instrument specifications, e.g. after a cache refresh
+    def update_instruments(self, instruments, market=None):
+        self.instruments = instruments
+        self.market = market if market is not None else MarketIndex(instruments, self.tickers)
+
+    @property
+    def source_portfolio_value(self):
+        return self.source_accounts['accounts']['flex']['portfolioValue']
+
+    @property
+    def your_portfolio_value(self):
+        return self.your_accounts['accounts']['flex']['portfolioValue']
+
+# raised when a symbol is missing from the instruments, tickers or positions of a snapshot
+class UnknownSymbolError(LookupError):
+    pass
+
+# order specifications of one instrument
+class InstrumentSpec(object):
+    __slots__ = ('symbol', 'tickSize', 'contractValueTradePrecision')
+
+    def __init__(self, symbol, tickSize, contractValueTradePrecision):
+        self.symbol = symbol
+        self.tickSize = tickSize
+        self.contractValueTradePrecision = contractValueTradePrecision
+
+# one open position, size is signed (negative for short)
+class Position(object):
+    __slots__ = ('symbol', 'size')
+
+    def __init__(self, symbol, size):
+        self.symbol = symbol
+        self.size = size
+
+# symbol-keyed lookups over the instruments and tickers of a snapshot, built once instead of scanning the lists per symbol
+class MarketIndex(object):
+    def __init__(self, instruments, tickers):
+        self.specs = {}
+        for i in instruments:
+            if i.get('tickSize') is not None and i.get('contractValueTradePrecision') is not None:  # indices have no order specs
+                self.specs[i['symbol']] = InstrumentSpec(i['symbol'], i['tickSize'], i['contractValueTradePrecision'])
+        self.markPrices = { t['symbol']: t['markPrice'] for t in tickers if t.get('markPrice') is not None }
+
+    def spec(self, symbol):
+        try:
+            return self.specs[symbol]
+        except KeyError:
+            raise UnknownSymbolError('No instrument specification for symbol %s' % symbol) from None
+
+    def mark_price(self, symbol):
+        try:
+            return self.markPrices[symbol]
+        except KeyError:
+            raise UnknownSymbolError('No mark price for symbol %s' % symbol) from None
+
+    # size rounded to the contract precision, avoids "sendStatus":{"status":"invalidSize"}
+    def round_size(self, symbol, size):
+        return round( size, self.spec(symbol).contractValueTradePrecision )
+
+    # mark price rounded to the tick size, away from the book for the given side, avoids "sendStatus":{"status":"invalidPrice"}
+    def limit_price(self, symbol, side):
+        tickSize = self.spec(symbol).tickSize
+        markPrice = self.mark_price(symbol)
+        if side == 'buy':
+            return math.ceil( markPrice / tickSize ) * tickSize
+        return math.floor( markPrice / tickSize ) * tickSize
+
+# open positions keyed by symbol
+def index_positions(positions):
+    return { p['symbol']: Position(p['symbol'], p['size'] * ( 1 if p['side'] == 'long' else -1 )) for p in positions }
+
+# writes obj as json to path through a temporary file, atomic: readers and a crash never see a half written file
+def write_json_atomic(path, obj):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(obj, f, separators=(',', ':'))
+    os.replace(tmp, path)
+
+# parsed instrument specifications, kept on disk with a TTL and revalidated in the background when stale
+class InstrumentCache(object):
+    fields = ('symbol', 'tickSize', 'contractValueTradePrecision')
+
+    def __init__(self, client, path=instrumentsCachePath, ttl=instrumentsCacheTtl):
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.instruments = None
+        self.fetched = 0  # unix time of the last download
+        self._lock = threading.Lock()
+        self._revalidation = None
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.instruments, self.fetched = data['instruments'], data['fetched']
+        except (OSError, ValueError, KeyError):
+            pass  # no usable cache yet
+
+    # stores a full instruments response, keeping only the fields we use
+    def update(self, instruments):
+        with self._lock:
+            self.instruments = [ { k: i.get(k) for k in self.fields } for i in instruments ]
+            self.fetched = time.time()
+            write_json_atomic(self.path, { 'fetched': self.fetched, 'instruments': self.instruments })
+        return self.instruments
+
+    # downloads the instruments right away
+    def refresh(self):
+        return self.update(self.client.get_instruments()['instruments'])
+
+    # cached instruments or None if there are none yet; stale ones are returned and revalidated in the background
+    def get(self):
+        if self.instruments is not None and time.time() - self.fetched >= self.ttl:
+            self.revalidate()
+        return self.instruments
+
+    def revalidate(self):
+        if self._revalidation is not None and self._revalidation.is_alive():
+            return
+        # not a daemon thread, so a one-shot run waits for the new cache to be written before exiting
+        self._revalidation = threading.Thread(target=self._revalidate, name='instruments-revalidation')
+        self._revalidation.start()
+
+    def _revalidate(self):
+        try:
+            self.refresh()
+        except Exception as e:
+            log(None, 'instruments revalidation failed:', repr(e), '\n')
+
+futureFillTimeRejected = False  # set once the exchange answered a lastFillTime in the future with an error
+
+# the newest page of fills. The 100 fills before a time a day from now are the newest ones too, but asking
+# for them with lastFillTime costs 2 instead of 25 rate limit units. That use of lastFillTime is not documented,
+# so when the exchange rejects it the full price request is used instead, for the rest of the run.
+def newest_fills(client):
+    global futureFillTimeRejected
+    if not futureFillTimeRejected:
+        until = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=1)
+        try:
+            response = client.get_fills(lastFillTime=until.strftime('%Y-%m-%dT%H:%M:%S.000Z'))
+        except urllib2.HTTPError as e:
+            if e.code >= 500 or e.code == 429:
+                raise  # not an answer about the request itself
+            response = {'error': '%d %s' % (e.code, e.reason)}
+        if 'fills' in response:
+            return response['fills']
+        log(None, 'get_fills rejected a future lastFillTime (%s), reading the newest fills without it\n' % response.get('error'))
+        futureFillTimeRejected = True
+    return client.get_fills()['fills']
+
+# your positions, kept on disk and brought up to date with the fills since the last cycle.
+# Open positions are read again every `resyncInterval` seconds, after invalidate() and when more fills arrived than one page holds.
+class PositionState(object):
+    def __init__(self, path, account="", resyncInterval=positionsResyncInterval):
+        self.path = path
+        self.account = account  # fingerprint of the API key, a state written for another account is ignored
+        self.resyncInterval = resyncInterval
+        self.positions = None  # signed sizes keyed by symbol
+        self.lastFillTime = None  # the newest applied fill
+        self.lastFillIds = []  # applied fills at lastFillTime, several fills can share a timestamp
+        self.synced = 0  # unix time of the last full read
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            if data['account'] == self.account:
+                self.positions, self.lastFillTime, self.lastFillIds, self.synced = data['positions'], data['lastFillTime'], data['lastFillIds'], data['synced']
+        except (OSError, ValueError, KeyError):
+            pass  # no usable state yet
+
+    def save(self):
+        write_json_atomic(self.path, { 'account': self.account, 'positions': self.positions, 'lastFillTime': self.lastFillTime,
+                                       'lastFillIds': self.lastFillIds, 'synced': self.synced })
+
+    # the next fetch reads all open positions again
+    def invalidate(self):
+        self.synced = 0
+        if self.positions is not None:
+            self.save()
+
+    # your open positions in the get_openpositions format
+    def open_positions(self):
+        return [ {'symbol': s, 'side': 'long' if size > 0 else 'short', 'size': abs(size)} for s, size in self.positions.items() ]
+
+    def fetch(self, client):
+        if self.positions is None or time.time() - self.synced >= self.resyncInterval:
+            return self.resync(client)
+        # the fills endpoint only pages backwards in time, so ask for the newest page and keep what is after the cursor
+        new = self.new_fills(newest_fills(client))
+        if new is None:
+            log(None, 'more new fills than one page, reading all positions\n')
+            return self.resync(client)
+        if new:
+            self.apply(new)
+            self.advance(new)
+            self.save()
+        return self.open_positions()
+
+    # reads all open positions, applies the fills that came after them and moves the cursor to the newest fill
+    def resync(self, client):
+        response = client.get_openpositions()
+        fills = sorted(newest_fills(client), key=lambda f: f['fillTime'])
+        self.positions = {}
+        for p in response['openPositions']:
+            self.positions[p['symbol']] = p['size'] * ( 1 if p['side'] == 'long' else -1 )
+        serverTime = response.get('serverTime')
+        if serverTime:
+            self.apply([ f for f in fills if f['fillTime'] > serverTime ])
+        self.lastFillTime, self.lastFillIds = None, []
+        self.advance(fills)
+        self.synced = time.time()
+        self.save()
+        return self.open_positions()
+
+    # the fills after the cursor, oldest first, or None if the cursor is not on this page
+    def new_fills(self, fills):
+        fills = sorted(fills, key=lambda f: f['fillTime'])
+        if self.lastFillTime is None:
+            new = fills
+        else:
+            new = [ f for f in fills if f['fillTime'] > self.lastFillTime or (f['fillTime'] == self.lastFillTime and f['fill_id'] not in self.lastFillIds) ]
+        if len(fills) >= fillsPageSize and len(new) == len(fills):
+            return None  # fills between this page and the cursor are missing
+        return new
+
+    def apply(self, fills):
+        for f in fills:
+            size = round( self.positions.get(f['symbol'], 0) + ( f['size'] if f['side'] == 'buy' else -f['size'] ), 10 )
+            if size:
+                self.positions[f['symbol']] = size
+            else:
+                self.positions.pop(f['symbol'], None)
+
+    # moves the cursor to the newest of the fills, which are sorted oldest first
+    def advance(self, fills):
+        if not fills:
+            return
+        newest = fills[-1]['fillTime']
+        ids = self.lastFillIds if newest == self.lastFillTime else []
+        self.lastFillTime = newest
+        self.lastFillIds = ids + [ f['fill_id'] for f in fills if f['fillTime'] == newest ]
+
+# runs fn and returns (result, seconds taken)
+def timed_call(fn):
+    start = time.perf_counter()
+    result = fn()
+    return result, time.perf_counter() - start
+
+# an account that copies the source
+class Follower(object):
+    def __init__(self, name, client, state=None):
+        self.name = name  # used in logs and timings
+        self.client = client
+        self.state = state  # optional PositionState, positions are read in full every cycle without one
+
+    def fetch_positions(self):
+        if self.state is None:
+            return self.client.get_openpositions()['openPositions']
+        return self.state.fetch(self.client)
+
+# fetches all independent snapshot calls concurrently, so a cycle waits for the slowest round trip instead of the sum.
+# Market data and source account are fetched once and shared by the snapshots of all followers, and a failure there is raised.
+# One snapshot per follower is returned, or the exception of a failed follower call so the other followers can go on.
+# Calls named in `prefetched` (e.g. "source_accounts", "<name>_accounts") are not made again, their result is used instead.
+def fetch_snapshots(cfPublic, cfSource, followers, instruments=None, executor=None, prefetched=None):
+    shared = ('instruments', 'source_accounts', 'source_positions', 'tickers')
+    calls = {
+        'instruments': lambda: instruments if instruments is not None else cfPublic.get_instruments()['instruments'],
+        'source_accounts': lambda: cfSource.get_accounts(),
+        'source_positions': lambda: cfSource.get_openpositions()['openPositions'],
+        'tickers': lambda: cfPublic.get_tickers()['tickers'],
+    }
+    for f in followers:
+        calls[f.name + '_accounts'] = lambda c=f.client: c.get_accounts()
+        calls[f.name + '_positions'] = f.fetch_positions
+    for name, value in (prefetched or {}).items():
+        if name in calls:
+            calls[name] = lambda value=value: value
+
+    start = time.perf_counter()
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=len(calls))
+    try:
+        futures = {name: executor.submit(timed_call, fn) for name, fn in calls.items()}
+        results, errors = {}, {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                if name in shared:
+                    raise
+                errors[name] = e
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+    elapsed = time.perf_counter() - start
+
+    timings = {name: r[1] for name, r in results.items()}
+    market = MarketIndex(results['instruments'][0], results['tickers'][0])
+    source_book = index_positions(results['source_positions'][0])
+    return [
+        errors.get(f.name + '_accounts') or errors.get(f.name + '_positions') or Snapshot(
+            instruments=results['instruments'][0],
+            tickers=results['tickers'][0],
+            source_accounts=results['source_accounts'][0],
+            your_accounts=results[f.name + '_accounts'][0],
+            source_positions=results['source_positions'][0],
+            your_positions=results[f.name + '_positions'][0],
+            timings=timings,
+            elapsed=elapsed,
+            market=market,
+            source_book=source_book,
+        )
+        for f in followers
+    ]
+
+# the orders that bring your positions in line with the source, one column per field and one row per symbol.
+# Immutable and computed without any network calls, so it can be inspected, printed (dry run) and tested on its own.
+class RebalancePlan(namedtuple('RebalancePlan', 'pfratio symbols current desired deltas sides limitPrices reduceOnly')):
+    __slots__ = ()
+
+    # the rows that need an order, as send_order_1 style orders
+    def orders(self):
+        orders = []
+        for s, delta, side, limitPrice, reduceOnly in zip(self.symbols, self.deltas, self.sides, self.limitPrices, self.reduceOnly):
+            if abs( delta ) > 0:
+                order = {
                   "orderType": "lmt"      # simple Limit order, don't mess with post-only
                   , "symbol": s
-                  , "side": ( 'buy' if position_adjustment > 0 else 'sell' )
-                  , "size": abs( position_adjustment )
+                  , "side": side
+                  , "size": abs( delta )
                   , "limitPrice": limitPrice
-                  , "reduceOnly": "true"
                 }
-                result = cfYour.send_order_1(limit_order)
-                print("closing position:\n", limit_order, '\n', result)
-      #print('\n')
-  
-    # adjust your positions to those of the source
-    for source_pos in source_positions: 
-        s = source_pos['symbol']
-        #print( s )
-        desired_position = pfratio * source_pos['size'] * ( 1 if source_pos['side'] == 'long' else -1 )
-        # find corresponding position in your account
-        current_position = [ p for p in your_positions if p['symbol'] == s ]
-        current_position = current_position[0]['size'] if len( current_position ) == 1 else 0   # put zero if not found
-        #print( 'desired_position:', desired_position, 'current_position:', current_position )
-        # send limit order
-        contractValueTradePrecision = [ i['contractValueTradePrecision'] for i in instruments if i['symbol'] == s ][0]
-        #print( 'contractValueTradePrecision', contractValueTradePrecision, 'decimals' )
-        position_adjustment = round( desired_position - current_position, contractValueTradePrecision )  # avoid "sendStatus":{"status":"invalidSize"} issue
-        #print( 'position_adjustment', position_adjustment )
-        if abs( position_adjustment ) > 0:
-            markPrice = [ t['markPrice'] for t in tickers if t['symbol'] == s ][0]
-            # price must have correct precision (different from contractValueTradePrecision) avoid "sendStatus":{"status":"invalidPrice"} issue
-            tickSize = [ i['tickSize'] for i in instruments if i['symbol'] == s ][0]
-            if position_adjustment > 0:
-                limitPrice = math.ceil( markPrice / tickSize ) * tickSize
-            else:
-                limitPrice = math.floor( markPrice / tickSize ) * tickSize
-            limit_order = { 
-              "orderType": "lmt" # simple Limit order, don't mess with post-only
-              , "symbol": s
-              , "side": ( 'buy' if position_adjustment > 0 else 'sell' )
-              , "size": abs( position_adjustment )
-              , "limitPrice": limitPrice
-            }
-            result = cfYour.send_order_1(limit_order)
-            print("sent order:\n", limit_order, '\n', result)
-        #print('\n')
+                if reduceOnly:
+                    order["reduceOnly"] = "true"
+                orders.append(order)
+        return orders
+
+    # one line per symbol, for dry runs and logs
+    def describe(self):
+        lines = [ 'pfratio: %s' % self.pfratio, '%-16s %14s %14s %14s %5s %14s' % ('symbol', 'current', 'desired', 'adjustment', 'side', 'limitPrice') ]
+        for row in zip(self.symbols, self.current, self.desired, self.deltas, self.sides, self.limitPrices, self.reduceOnly):
+            s, current, desired, delta, side, limitPrice, reduceOnly = row
+            lines.append('%-16s %14.6g %14.6g %14.6g %5s %14s%s' % (s, current, desired, delta, side if delta else '', limitPrice if delta else '', ' close' if reduceOnly else ''))
+        return '\n'.join(lines)
+
+# computes the rebalance plan for a snapshot: desired sizes, adjustments rounded to the contract precision and tick-aligned limit prices
+def plan_rebalance(snapshot):
+    # get futures portfolio value ratio (including unrealized PnL)
+    source_portfolio_value = snapshot.source_portfolio_value
+    your_portfolio_value = snapshot.your_portfolio_value
+
+    if your_portfolio_value <= 100:  # stop if your account is almost empty (which would cause strategy to behave irregularly)
+        raise ValueError('Your account has < 100 USD value, causing strategy to become irregular or unreliable.')
+    if source_portfolio_value <= 500:  # avoid division by zero, and also stop if source account is almost empty (which would cause strategy to behave irregularly)
+        raise ValueError('The SOURCE account has < 500 USD value, causing strategy to become irregular or unreliable.')
+
+    pfratio = your_portfolio_value / source_portfolio_value
 
+    # current futures positions, keyed by symbol with signed sizes
+    source_book = snapshot.source_book
+    your_book = snapshot.your_book
+
+    # instrument specs and current prices (fetched together with the positions so they are as fresh as possible), keyed by symbol
+    market = snapshot.market
+
+    # first close any of your positions that no longer appear in source positions list, then follow the source positions
+    closing = [ s for s in your_book if s not in source_book ]
+    symbols = tuple(closing) + tuple(source_book)
+    reduceOnly = (True,) * len(closing) + (False,) * len(source_book)
+    desired = (0,) * len(closing) + tuple( pfratio * p.size for p in source_book.values() )
+    current = tuple( your_book[s].size if s in your_book else 0 for s in symbols )   # put zero if not found
+
+    # round to the contract precision to avoid "sendStatus":{"status":"invalidSize"} issue
+    deltas = tuple( market.round_size( s, d - c ) for s, d, c in zip(symbols, desired, current) )
+    sides = tuple( 'buy' if delta > 0 else 'sell' for delta in deltas )
+    # price must have correct precision (different from contractValueTradePrecision) to avoid "sendStatus":{"status":"invalidPrice"} issue
+    limitPrices = tuple( market.limit_price( s, side ) if abs( delta ) > 0 else None for s, delta, side in zip(symbols, deltas, sides) )
+
+    return RebalancePlan(pfratio, symbols, current, desired, deltas, sides, limitPrices, reduceOnly)
+
+# outcome of one submitted order, edit or cancel
+class OrderResult(object):
+    __slots__ = ('order', 'status', 'order_id', 'response', 'batched', 'action', 'sent')
+
+    def __init__(self, order, status, order_id, response, batched, action='send', sent=None):
+        self.order = order  # the send_order_1 style order (also for a kept order), the edit_order style edit, or the order id to cancel
+        self.status = status  # e.g. "placed", "edited", "cancelled", "invalidSize", "invalidPrice", "insufficientAvailableFunds"
+        self.order_id = order_id
+        self.response = response  # status element of the batch, the full single order response, or the kept open order
+        self.batched = batched
+        self.action = action  # "send", "edit", "cancel", or "keep" for an open order that already matched the plan
+        self.sent = sent  # unix time just before the request went out, or when a kept order was received
+
+    @property
+    def ok(self):
+        return self.status == {'send': 'placed', 'edit': 'edited', 'cancel': 'cancelled', 'keep': 'kept'}[self.action]
+
+# batchorder instruction for a send_order_1 style order
+def batch_instruction(order, tag):
+    instruction = dict(order, order="send", order_tag=tag)
+    if 'reduceOnly' in instruction:
+        instruction['reduceOnly'] = instruction['reduceOnly'] in (True, 'true')
+    return instruction
+
+# batchorder instruction for an action: ("send", order), ("edit", edit) or ("cancel", order_id).
+# Only sends carry an order_tag, edits and cancels are identified by their order_id
+def action_instruction(action, payload, tag):
+    if action == 'edit':
+        return {"order": "edit", "order_id": payload['orderId'], "size": payload['size'], "limitPrice": payload['limitPrice']}
+    if action == 'cancel':
+        return {"order": "cancel", "order_id": payload}
+    return batch_instruction(payload, tag)
+
+def send_single_order(client, order):
+    response = client.send_order_1(order)
+    sendStatus = response.get('sendStatus', {})
+    return OrderResult(order, sendStatus.get('status', response.get('error')), sendStatus.get('order_id'), response, False)
+
+def edit_single_order(client, edit):
+    response = client.edit_order(edit)
+    editStatus = response.get('editStatus', {})
+    return OrderResult(edit, editStatus.get('status', response.get('error')), edit['orderId'], response, False, 'edit')
+
+def cancel_single_order(client, order_id):
+    response = client.cancel_order(order_id=order_id)
+    cancelStatus = response.get('cancelStatus', {})
+    return OrderResult(order_id, cancelStatus.get('status', response.get('error')), order_id, response, False, 'cancel')
+
+singleActions = {'send': send_single_order, 'edit': edit_single_order, 'cancel': cancel_single_order}
+
+# sends one chunk of (action, payload) pairs through send_batchorder, returns None if the batch as a whole was rejected:
+# the exchange answered with an error, or with an HTTP 4xx status such as 429, which means the batch did not run
+def send_batch_actions(client, actions):
+    instructions = [ action_instruction(action, payload, str(n)) for n, (action, payload) in enumerate(actions) ]
+    try:
+        response = client.send_batchorder(json.dumps({"batchOrder": instructions}, separators=(',', ':')))
+    except urllib2.HTTPError as e:
+        # a server or gateway error does not tell whether the batch ran, sending its orders again could double them
+        if e.code >= 500:
+            raise
+        log(None, 'batchorder rejected:', e.code, e.reason)
+        return None
+    if response.get('result') != 'success':
+        log(None, 'batchorder rejected:', response.get('error'))
+        return None
+
+    # send statuses come back with their order_tag, edit and cancel statuses only with the order_id, which is unique within a batch
+    byTag = { b['order_tag']: b for b in response.get('batchStatus', []) if b.get('order_tag') is not None }
+    byId = { b['order_id']: b for b in response.get('batchStatus', []) if b.get('order_tag') is None and b.get('order_id') is not None }
+    results = []
+    for n, (action, payload) in enumerate(actions):
+        order_id = None if action == 'send' else payload['orderId'] if action == 'edit' else payload
+        b = byTag.get(str(n), {}) if action == 'send' else byId.get(order_id, {})
+        results.append(OrderResult(payload, b.get('status', 'missing'), b.get('order_id', order_id), b, True, action))
+    return results
+
+# submits (action, payload) pairs in chunks of `batchSize` per batchorder request,
+# falling back to single requests for chunks of one or when a batch is rejected; returns one OrderResult per action
+def submit_actions(client, actions, chunkSize=None):
+    chunkSize = batchSize if chunkSize is None else chunkSize  # the setting at call time
+    if chunkSize <= 1:
+        return [ singleActions[action](client, payload) for action, payload in actions ]
+
+    results = []
+    for start in range(0, len(actions), chunkSize):
+        chunk = actions[start:start + chunkSize]
+        chunk_results = send_batch_actions(client, chunk) if len(chunk) > 1 else None
+        if chunk_results is None:
+            chunk_results = [ singleActions[action](client, payload) for action, payload in chunk ]
+        results.extend(chunk_results)
+    return results
+
+# submits orders like submit_actions, returns one OrderResult per order
+def submit_orders(client, orders, chunkSize=None):
+    return submit_actions(client, [ ('send', order) for order in orders ], chunkSize)
+
+# what to do with your open orders so that exactly the planned orders rest on the book; kept holds (open order, planned order) pairs
+class Reconciliation(namedtuple('Reconciliation', 'kept edits cancels sends')):
+    __slots__ = ()
+
+    # cancels first to free margin, then edits, then new orders
+    def actions(self):
+        return [ ('cancel', o['order_id']) for o in self.cancels ] + [ ('edit', e) for e in self.edits ] + [ ('send', o) for o in self.sends ]
+
+def same_amount(a, b):
+    return math.isclose(float(a), float(b), rel_tol=1e-9, abs_tol=1e-12)
+
+# True if an order at `price` is at the planned price, or past it towards the market by at most `slippage` of it
+def within_slippage(price, plannedPrice, side, slippage):
+    if same_amount(price, plannedPrice):
+        return True
+    ahead = (float(price) - plannedPrice) * (1 if side == 'buy' else -1)
+    return 0 < ahead <= plannedPrice * slippage * (1 + 1e-9)
+
+# diffs your open orders against the planned orders: an open limit order on the same symbol, side and reduce-only flag
+# is kept when its unfilled size matches and its price does too, or was chased at most `slippage` beyond it;
+# it is amended with edit_order otherwise. Every other open order is cancelled
+def reconcile_orders(open_orders, orders, slippage=0):
+    candidates = {}
+    for o in open_orders:
+        if o.get('orderType', 'lmt') == 'lmt':
+            key = (o['symbol'], o['side'], bool(o.get('reduceOnly')))
+            candidates.setdefault(key, []).append(o)
+    used = set()
+    kept, edits, sends = [], [], []
+    for order in orders:
+        key = (order['symbol'], order['side'], order.get('reduceOnly') in (True, 'true'))
+        matches = candidates.get(key, [])
+        exact = [ o for o in matches if same_amount(o['unfilledSize'], order['size']) and within_slippage(o['limitPrice'], order['limitPrice'], order['side'], slippage) ]
+        if exact:
+            kept.append((exact[0], order))
+            matches.remove(exact[0])
+        elif matches:
+            o = matches.pop(0)
+            # the edited size is the whole order size, including what was already filled
+            edits.append({"orderId": o['order_id'], "size": round(float(o.get('filledSize') or 0) + order['size'], 12), "limitPrice": order['limitPrice']})
+            used.add(o['order_id'])
+        else:
+            sends.append(order)
+    used.update( o['order_id'] for o, order in kept )
+    cancels = [ o for o in open_orders if o['order_id'] not in used ]
+    return Reconciliation(kept, edits, cancels, sends)
+
+# unix time of an ISO 8601 timestamp like "2024-01-31T12:00:00.000Z", None if there is none
+def iso_time(timestamp):
+    try:
+        return datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00')).timestamp()
+    except (AttributeError, ValueError):
+        return None
+
+# an order being watched after it was sent: the price it was planned at and when it started resting
+class ChasedOrder(object):
+    __slots__ = ('order_id', 'plannedPrice', 'sent')
+
+    def __init__(self, order_id, plannedPrice, sent):
+        self.order_id = order_id
+        self.plannedPrice = plannedPrice
+        self.sent = sent
+
+# what became of the chased orders: seconds to fill keyed by order id, ids still open at the deadline,
+# ids that left the book without a fill in the newest fills page, and the number of price edits
+ChaseOutcome = namedtuple('ChaseOutcome', 'filled unfilled gone reprices')
+
+# limit price that reaches the opposite top of the book, but no further than `slippage` from the planned price,
+# rounded to the tick size towards the planned price; None if the book is empty on that side
+def chase_price(book, side, plannedPrice, tickSize, slippage):
+    if side == 'buy':
+        asks = book.get('asks')
+        if not asks:
+            return None
+        target = min( min( float(a[0]) for a in asks ), plannedPrice * (1 + slippage) )
+        return math.floor( target / tickSize + 1e-9 ) * tickSize
+    bids = book.get('bids')
+    if not bids:
+        return None
+    target = max( max( float(b[0]) for b in bids ), plannedPrice * (1 - slippage) )
+    return math.ceil( target / tickSize - 1e-9 ) * tickSize
+
+# watches the sent, edited and kept orders until they fill or `deadline` seconds pass, polling your open orders every
+# `interval` seconds. Orders still open after a check are moved towards the top of the book with edit_order, within
+# `slippage` of their planned price. Time to fill comes from your fills, orders left at the deadline rest until the next cycle.
+# `interrupt`, if given, is called after every check and ends the chase early when it returns True.
+def chase_orders(client, results, market, name=None, metrics=None, deadline=None, interval=None, slippage=None, interrupt=None):
+    # the settings at call time
+    deadline = chaseDeadline if deadline is None else deadline
+    interval = chaseInterval if interval is None else interval
+    slippage = chaseSlippage if slippage is None else slippage
+
+    start = time.time()
+    chased = {}
+    for r in results:
+        if r.ok and r.order_id and r.action in ('send', 'edit', 'keep'):
+            # time to fill counts from just before the order was sent, or since a kept order was received in an earlier cycle
+            chased[r.order_id] = ChasedOrder(r.order_id, float(r.order['limitPrice']), r.sent or start)
+    filled, gone, reprices = {}, [], 0
+
+    checks = 0
+    while chased:
+        open_orders = { o['order_id']: o for o in client.get_openorders()['openOrders'] if o['order_id'] in chased }
+        done = [ order_id for order_id in chased if order_id not in open_orders ]
+        if done:
+            # the last fill of an order completed it
+            fillTimes = {}
+            for f in newest_fills(client):
+                t = iso_time(f.get('fillTime'))
+                if f.get('order_id') in chased and t is not None:
+                    fillTimes[f['order_id']] = max(t, fillTimes.get(f['order_id'], t))
+            for order_id in done:
+                c = chased.pop(order_id)
+                if order_id in fillTimes:
+                    filled[order_id] = max(0.0, fillTimes[order_id] - c.sent)  # clocks can be a little apart
+                else:
+                    gone.append(order_id)  # cancelled, or filled longer ago than the newest fills page reaches
+        if not chased or time.time() - start >= deadline or (interrupt is not None and interrupt()):
+            break
+
+        # the first check only collects what filled right away, the orders get one interval at their planned price
+        if checks > 0:
+            symbols = sorted(set( open_orders[order_id]['symbol'] for order_id in chased ))
+            with ThreadPoolExecutor(max_workers=min(len(symbols), poolSize)) as executor:
+                books = dict(zip(symbols, executor.map(lambda s: client.get_orderbook(s)['orderBook'], symbols)))
+            edits = []
+            for order_id, c in chased.items():
+                o = open_orders[order_id]
+                tickSize = market.spec(o['symbol']).tickSize
+                price = chase_price(books[o['symbol']], o['side'], c.plannedPrice, tickSize, slippage)
+                # only ever towards the market, an order the book moved through is about to fill
+                if price is not None and (price - float(o['limitPrice'])) * (1 if o['side'] == 'buy' else -1) > tickSize / 2:
+                    size = round(float(o.get('filledSize') or 0) + float(o['unfilledSize']), 12)
+                    edits.append(('edit', {"orderId": order_id, "size": size, "limitPrice": price}))
+            if edits:
+                reprices += sum( 1 for r in submit_actions(client, edits) if r.ok )
+        checks += 1
+        time.sleep(max(0, min(interval, start + deadline - time.time())))
+
+    if filled or chased or gone:
+        times = sorted(filled.values())
+        log(name, 'orders:', len(filled), 'filled' + (' in %.1f s median, %.1f s max,' % (times[len(times) // 2], times[-1]) if times else ','),
+            len(chased), 'still open after', round(time.time() - start, 1), 's,', len(gone), 'gone,', reprices, 'repriced.\n')
+    if metrics is not None:
+        metrics.record_chase(list(filled.values()), len(chased), len(gone), reprices)
+    return ChaseOutcome(filled, list(chased), gone, reprices)
+
+# default accounts: the environment variables holding the API keys
+sourceEnv = ("KRAKEN_SOURCE_KEY", "KRAKEN_SOURCE_SECRET")
+followersEnv = [("your", "KRAKEN_YOUR_KEY", "KRAKEN_YOUR_SECRET")]  # (name, key variable, secret variable)
+
+# reads the source and followers from a JSON config file, which names the environment variables holding their API keys:
+# {"source": {"keyEnv": "KRAKEN_SOURCE_KEY", "secretEnv": "KRAKEN_SOURCE_SECRET"},
+#  "followers": [{"name": "alice", "keyEnv": "ALICE_KEY", "secretEnv": "ALICE_SECRET"}, ...]}
+def load_config(path):
+    with open(path) as f:
+        config = json.load(f)
+    source = config.get('source', {})
+    source_env = (source.get('keyEnv', sourceEnv[0]), source.get('secretEnv', sourceEnv[1]))
+    followers_env = [ (f['name'], f['keyEnv'], f['secretEnv']) for f in config['followers'] ]
+    names = [ f[0] for f in followers_env ]
+    if not names or len(set(names)) != len(names):
+        raise ValueError('The config needs at least one follower and unique follower names.')
+    return source_env, followers_env
+
+# check whether all keys are present
+def check_env(source_env=sourceEnv, followers_env=followersEnv):
+    required_env = list(source_env) + [ k for f in followers_env for k in f[1:] ]
+    missing = [k for k in required_env if k not in os.environ]
+    if missing:
+        raise RuntimeError(f"Missing required environment variables: {', '.join(missing)}")
+
+# the kept positions of a follower, stored per follower name and tied to its API key
+def position_state(name, apiPublicKey):
+    return PositionState(os.path.join(cacheDir, 'positions-%s.json' % name), account=hashlib.sha256(apiPublicKey.encode()).hexdigest()[:16])
+
+# returns the public and source clients and the followers, all sharing one connection pool
+def make_clients(source_env=sourceEnv, followers_env=followersEnv, metrics=None):
+    # one connection pool for all clients, so every request after the first skips the TCP and TLS handshake.
+    # A snapshot makes 4 shared calls and 2 per follower at the same time.
+    pool = cfConnectionPool(maxSize=max(poolSize, 4 + 2 * len(followers_env)), idleTimeout=poolIdleTimeout)
+    # one rate limiter too, it keeps a separate budget per API key
+    rateLimiter = cfRateLimiter() if useRateLimiter else None
+    # and one JSON decoder, it caches its typed decoders
+    decoder = cfJsonDecoder(jsonDecoder)
+
+    # removed "cfApi." before these methods:
+    cfPublic = cfApiMethods(apiPath, timeout=timeout, checkCertificate=checkCertificate, pool=pool, metrics=metrics, rateLimiter=rateLimiter, decoder=decoder, projectFields=projectFields)
+    cfSource = cfApiMethods(apiPath, timeout=timeout, apiPublicKey=os.environ[source_env[0]], apiPrivateKey=os.environ[source_env[1]], checkCertificate=checkCertificate, useNonce=useNonce, pool=pool, metrics=metrics, rateLimiter=rateLimiter, decoder=decoder, projectFields=projectFields)
+    followers = [
+        Follower(name, cfApiMethods(apiPath, timeout=timeout, apiPublicKey=os.environ[key], apiPrivateKey=os.environ[secret], checkCertificate=checkCertificate, useNonce=useNonce, pool=pool, metrics=metrics, rateLimiter=rateLimiter, decoder=decoder, projectFields=projectFields),
+                 state=position_state(name, os.environ[key]) if trackPositions else None)
+        for name, key, secret in followers_env
+    ]
+    return cfPublic, cfSource, followers
+
+logLock = threading.Lock()
+
+# prints, prefixed with the follower name when copying to several accounts. Followers log from parallel threads,
+# print writes every argument separately, so one line at a time
+def log(name, *args):
+    with logLock:
+        if name is None:
+            print(*args)
+        else:
+            print('[%s]' % name, *args)
+
+# brings your open orders in line with the plan, returns the OrderResults; open_orders skips reading them when just read
+def execute_plan(cfYour, plan, name=None, metrics=None, open_orders=None):
+    if not reconcileOrders:
+        return replace_orders(cfYour, plan, name=name, metrics=metrics)
+
+    # keep the open orders that still match the plan, amend or cancel the rest
+    with phase(metrics, 'reconcile'):
+        if open_orders is None:
+            open_orders = cfYour.get_openorders()['openOrders']
+        # orders chased towards the market in an earlier cycle keep their price
+        reconciliation = reconcile_orders(open_orders, plan.orders(), slippage=chaseSlippage if chaseDeadline > 0 else 0)
+    if open_orders:
+        log(name, 'open orders:', len(reconciliation.kept), 'kept,', len(reconciliation.edits), 'to edit,', len(reconciliation.cancels), 'to cancel.\n')
+
+    # cancels, edits and new orders at once, in as few requests as possible
+    with phase(metrics, 'submit'):
+        sent = time.time()
+        results = submit_actions(cfYour, reconciliation.actions())
+    for result in results:
+        result.sent = sent
+    for result in results:
+        if result.action == 'send':
+            log(name, "closing position:\n" if 'reduceOnly' in result.order else "sent order:\n", result.order, '\n', result.status, result.order_id)
+        else:
+            log(name, result.action, result.order, '\n', result.status)
+    return results + [ OrderResult(order, 'kept', o['order_id'], o, False, 'keep', iso_time(o.get('receivedTime'))) for o, order in reconciliation.kept ]
+
+# cancels all your open orders and sends the orders of the plan, returns the OrderResults
+def replace_orders(cfYour, plan, name=None, metrics=None):
+    # close all open orders
+    with phase(metrics, 'cancel'):
+        result = cfYour.cancel_all_orders()
+    if len(result['cancelStatus']['cancelledOrders']) > 0:
+        log(name, 'cancel_all_orders:\n', result['result'], 'cancelled', len(result['cancelStatus']['cancelledOrders']), 'orders.\n' )
+
+    # send all orders at once, in as few requests as possible
+    with phase(metrics, 'submit'):
+        sent = time.time()
+        results = submit_orders(cfYour, plan.orders())
+    for result in results:
+        result.sent = sent
+        log(name, "closing position:\n" if 'reduceOnly' in result.order else "sent order:\n", result.order, '\n', result.status, result.order_id)
+    return results
+
+# adjusts your portfolio to resemble the source portfolio in the given snapshot, returns the OrderResults
+def rebalance(cfYour, snapshot, name=None, dry_run=False, metrics=None, open_orders=None, interrupt=None):
+    log(name, 'your_portfolio_value:', snapshot.your_portfolio_value, 'USD\n')
+    with phase(metrics, 'plan'):
+        plan = plan_rebalance(snapshot)
+    if dry_run:
+        log(name, 'dry run, no orders sent:\n' + plan.describe() + '\n')
+        return []
+    results = execute_plan(cfYour, plan, name=name, metrics=metrics, open_orders=open_orders)
+    # make the orders fill before the market moves away from them
+    if chaseDeadline > 0:
+        try:
+            with phase(metrics, 'chase'):
+                chase_orders(cfYour, results, snapshot.market, name=name, metrics=metrics, interrupt=interrupt)
+        except Exception as e:  # the orders are in, whatever did not fill rests until the next cycle
+            log(name, 'chasing orders failed:', repr(e), '\n')
+    return results
+
+# one copy cycle: fetch one snapshot and rebalance every follower to it, returns the snapshots.
+# `prefetched` holds results read just before, by check_cycle, that the cycle does not read again; `interrupt` ends chase_orders early.
+# Raises when a follower failed, after the others were rebalanced: the error itself when there is only one follower.
+def run_cycle(cfPublic, cfSource, followers, cache, executor=None, dry_run=False, metrics=None, fingerprint=None, prefetched=None, interrupt=None):
+    snapshots, failed = run_cycle_isolated(cfPublic, cfSource, followers, cache, executor, dry_run, metrics, fingerprint, prefetched, interrupt)
+    if len(followers) == 1 and failed:
+        raise failed[0][1]
+    if failed:
+        raise RuntimeError('Rebalance failed for followers: %s' % ', '.join(name for name, e in failed)) from failed[0][1]
+    return snapshots
+
+# run_cycle that returns (snapshots, failed) instead of raising for failed followers, with the (name, exception) of each
+# and the exception in place of the snapshot of a follower that could not be read. Errors of the shared calls are raised.
+def run_cycle_isolated(cfPublic, cfSource, followers, cache, executor=None, dry_run=False, metrics=None, fingerprint=None, prefetched=None, interrupt=None):
+    with phase(metrics, 'cycle'):
+        return _run_cycle(cfPublic, cfSource, followers, cache, executor, dry_run, metrics, fingerprint, prefetched or {}, interrupt)
+
+def _run_cycle(cfPublic, cfSource, followers, cache, executor, dry_run, metrics, fingerprint, prefetched, interrupt):
+    # get general info about assets, portfolio values, positions and prices in one go, instruments come from the cache if possible
+    instruments = cache.get()
+    with phase(metrics, 'snapshot'):
+        snapshots = fetch_snapshots(cfPublic, cfSource, followers, instruments=instruments, executor=executor, prefetched=prefetched)
+    # a follower whose account or positions could not be read sits this cycle out
+    fetched = [ snapshot for snapshot in snapshots if not isinstance(snapshot, Exception) ]
+    if fetched:
+        print('snapshot fetched in', round(fetched[0].elapsed, 3), 's:', ', '.join('%s %.3f s' % (k, v) for k, v in fetched[0].timings.items()), '\n')
+        if instruments is None:
+            cache.update(fetched[0].instruments)
+    #print( [ i for i in snapshots[0].instruments if i['symbol'] == 'PF_XBTUSD' ], '\n')
+
+    # a symbol that is not in the cached instruments may have been listed since the cache was written
+    unknown = set( s for snapshot in fetched for s in list(snapshot.source_book) + list(snapshot.your_book) if s not in snapshot.market.specs )
+    if unknown and instruments is not None:
+        print('unknown symbols', sorted(unknown), 'refreshing instruments\n')
+        instruments = cache.refresh()
+        market = MarketIndex(instruments, fetched[0].tickers)
+        for snapshot in fetched:
+            snapshot.update_instruments(instruments, market)
+
+    # rebalance the followers in parallel, an error in one follower does not stop the others
+    def rebalance_follower(follower, snapshot):
+        if isinstance(snapshot, Exception):
+            log(follower.name, 'snapshot failed:', repr(snapshot), '\n')
+            return snapshot
+        try:
+            return rebalance(follower.client, snapshot, name=follower.name if len(followers) > 1 else None, dry_run=dry_run, metrics=metrics,
+                             open_orders=prefetched.get(follower.name + '_orders'), interrupt=interrupt)
+        except Exception as e:
+            log(follower.name, 'rebalance failed:', repr(e), '\n')
+            return e
+
+    if len(followers) == 1:
+        outcomes = [ rebalance_follower(followers[0], snapshots[0]) ]
+    else:
+        own_executor = executor is None
+        if own_executor:
+            executor = ThreadPoolExecutor(max_workers=len(followers))
+        try:
+            futures = [ executor.submit(rebalance_follower, f, snapshot) for f, snapshot in zip(followers, snapshots) ]
+            outcomes = [ future.result() for future in futures ]
+        finally:
+            if own_executor:
+                executor.shutdown(wait=False)
+
+    # a closing order that would not reduce the position means the kept positions are off, read them in full next cycle
+    for f, results in zip(followers, outcomes):
+        if f.state is not None and not isinstance(results, Exception) and any( r.status == 'wouldNotReducePosition' for r in results ):
+            log(f.name, 'positions out of sync, reading them in full next cycle\n')
+            f.state.invalidate()
+
+    # tick size or precision changed, refresh so the next cycle uses the new specifications
+    if any( r.status in ('invalidSize', 'invalidPrice') for results in outcomes if not isinstance(results, Exception) for r in results ):
+        print('orders rejected for size or price, refreshing instruments\n')
+        cache.refresh()
+
+    failed = [ (f.name, e) for f, e in zip(followers, outcomes) if isinstance(e, Exception) ]
+
+    # only a cycle in which every follower got all its orders in may be skipped next time
+    if fingerprint is not None and not dry_run:
+        if failed or not all( r.ok for results in outcomes if not isinstance(results, Exception) for r in results ):
+            fingerprint.clear()
+        else:
+            fingerprint.record(snapshots, followers)
+
+    return snapshots, failed
+
+# compact, order independent view of a positions list, used to detect changes
+def positions_key(positions):
+    return tuple(sorted( (s, p.size) for s, p in index_positions(positions).items() ))
+
+# what the last successful cycle copied: a fingerprint of the source positions and the portfolio ratio of every follower
+class CycleFingerprint(object):
+    def __init__(self, path=fingerprintPath, threshold=pfratioDriftThreshold):
+        self.path = path
+        self.threshold = threshold
+        self.source = None
+        self.pfratios = {}  # keyed by follower name
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+            self.source, self.pfratios = data['source'], data['pfratios']
+        except (OSError, ValueError, KeyError):
+            pass  # no fingerprint yet, the next run is a full cycle
+
+    def save(self):
+        write_json_atomic(self.path, { 'source': self.source, 'pfratios': self.pfratios })
+
+    @staticmethod
+    def source_fingerprint(positions):
+        return hashlib.sha256(repr(positions_key(positions)).encode()).hexdigest()[:16]
+
+    def record(self, snapshots, followers):
+        self.source = self.source_fingerprint(snapshots[0].source_positions)
+        self.pfratios = { f.name: s.your_portfolio_value / s.source_portfolio_value for f, s in zip(followers, snapshots) }
+        self.save()
+
+    def clear(self):
+        if self.source is not None:
+            self.source, self.pfratios = None, {}
+            self.save()
+
+    # True if the source positions are the recorded ones and every ratio stayed within the threshold
+    def unchanged(self, source_positions, pfratios):
+        if self.threshold <= 0 or self.source is None or self.source_fingerprint(source_positions) != self.source:
+            return False
+        return all( name in self.pfratios and abs( pfratio / self.pfratios[name] - 1 ) < self.threshold for name, pfratio in pfratios.items() )
+
+# outcome of check_cycle: whether the cycle can be skipped, and the results it read keyed by call name, for run_cycle
+CycleCheck = namedtuple('CycleCheck', 'unchanged prefetched')
+
+# checks with as few calls as possible whether a cycle would change anything: the source positions and portfolio value,
+# and the portfolio value and open orders of every follower (orders still waiting need the full cycle to reprice them).
+# A failed call means the cycle runs; it reads again only what failed, and handles a failing follower on its own.
+def check_cycle(cfSource, followers, fingerprint, executor=None):
+    if fingerprint.threshold <= 0 or fingerprint.source is None:
+        return CycleCheck(False, {})
+    calls = {
+        'source_accounts': lambda: cfSource.get_accounts(),
+        'source_positions': lambda: cfSource.get_openpositions()['openPositions'],
+    }
+    for f in followers:
+        calls[f.name + '_accounts'] = lambda c=f.client: c.get_accounts()
+        calls[f.name + '_orders'] = lambda c=f.client: c.get_openorders()['openOrders']
+
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=len(calls))
+    try:
+        futures = {name: executor.submit(fn) for name, fn in calls.items()}
+        results = {}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception:
+                pass  # the cycle reads it again and reports the error
+    finally:
+        if own_executor:
+            executor.shutdown(wait=False)
+
+    if len(results) < len(calls) or any( results[f.name + '_orders'] for f in followers ):
+        return CycleCheck(False, results)
+    source_portfolio_value = results['source_accounts']['accounts']['flex']['portfolioValue']
+    if source_portfolio_value <= 0:
+        return CycleCheck(False, results)
+    pfratios = { f.name: results[f.name + '_accounts']['accounts']['flex']['portfolioValue'] / source_portfolio_value for f in followers }
+    return CycleCheck(fingerprint.unchanged(results['source_positions'], pfratios), results)
+
+# ends the order chase of a resident cycle once the source positions differ from the copied ones or a stop is requested.
+# The followers chase in parallel and share one watch, which polls the source at most every pollIntervalMin seconds.
+class SourceWatch(object):
+    def __init__(self, cfSource, key, stop):
+        self.cfSource = cfSource
+        self.key = key  # positions_key of the copied source positions
+        self.stop = stop
+        self.changed = False
+        self.polled = time.monotonic()
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            if not self.changed and not self.stop.is_set() and time.monotonic() - self.polled >= pollIntervalMin:
+                self.polled = time.monotonic()
+                try:
+                    self.changed = positions_key(self.cfSource.get_openpositions()['openPositions']) != self.key
+                except Exception:
+                    pass  # keep chasing, the next check polls again
+            return self.changed or self.stop.is_set()
+
+# resident mode: keeps clients and instruments in memory, polls the source positions and rebalances when they change
+def run_daemon(cfPublic, cfSource, followers, cache, stop, dry_run=False, metrics=None, fingerprint=None):
+    executor = ThreadPoolExecutor(max_workers=4 + 2 * len(followers))
+    last_key = None
+    last_cycle = 0
+    interval = pollIntervalMin
+
+    try:
+        while not stop.is_set():
+            try:
+                now = time.monotonic()
+                source_positions = cfSource.get_openpositions()['openPositions']
+                key = positions_key(source_positions)
+                # the cycle copies the positions just polled instead of reading them again
+                check = CycleCheck(False, {'source_positions': source_positions})
+                if key == last_key and now - last_cycle >= resyncInterval and fingerprint is not None and not dry_run:
+                    check = check_cycle(cfSource, followers, fingerprint, executor=executor)
+                if check.unchanged:
+                    # periodic cycle, but the portfolio ratios are still within the threshold
+                    last_cycle = now
+                    interval = min(interval * 1.5, pollIntervalMax)
+                elif key != last_key or now - last_cycle >= resyncInterval:
+                    if key != last_key:
+                        print(datetime.datetime.now().isoformat(), 'source positions changed\n')
+                    # a source change during the order chase ends it, so the change is copied right away instead of after chaseDeadline
+                    watch = SourceWatch(cfSource, key, stop)
+                    failed = run_cycle_isolated(cfPublic, cfSource, followers, cache, executor=executor, dry_run=dry_run, metrics=metrics,
+                                                fingerprint=fingerprint, prefetched=check.prefetched, interrupt=watch)[1]
+                    # the cycle copied the polled source positions. A failed follower is tried again with the next change or
+                    # periodic cycle, not on every poll, so it does not make the healthy followers cycle over and over
+                    if failed:
+                        print(datetime.datetime.now().isoformat(), 'cycle failed for followers:', ', '.join(name for name, e in failed), '\n')
+                    last_key = key
+                    last_cycle = now
+                    interval = 0 if watch.changed else pollIntervalMin
+                else:
+                    # nothing changed: back off towards the maximum poll interval
+                    interval = min(interval * 1.5, pollIntervalMax)
+            except Exception as e:
+                # keep running, the next poll retries
+                print(datetime.datetime.now().isoformat(), 'cycle failed:', repr(e), '\n')
+                interval = pollIntervalMax
+            stop.wait(interval)
+    finally:
+        executor.shutdown(wait=True)
+        cfPublic.pool.close()
+    print('stopped')
+
+# writes the metrics summary as JSON to path, "-" for stdout
+def write_metrics(metrics, path):
+    summary = json.dumps(metrics.summary(), indent=2)
+    if path == '-':
+        print(summary)
+    else:
+        with open(path, 'w') as f:
+            f.write(summary + '\n')
+
+def main():
+    parser = argparse.ArgumentParser(description="Copy Futures positions between Kraken accounts.")
+    parser.add_argument("--daemon", action="store_true", help="keep running and rebalance whenever the source positions change")
+    parser.add_argument("--config", help="JSON file with one source and several followers, see followers.example.json")
+    parser.add_argument("--dry-run", action="store_true", help="print the planned orders without cancelling or sending any")
+    parser.add_argument("--metrics-json", metavar="PATH", help="write request and phase timings as JSON at the end of the run, - for stdout")
+    parser.add_argument("--metrics-port", type=int, metavar="PORT", help="with --daemon, serve Prometheus metrics at http://127.0.0.1:PORT/metrics")
+    args = parser.parse_args()
+    if args.metrics_port is not None and not args.daemon:
+        parser.error("--metrics-port needs --daemon")
+
+    # metrics stay off (None) unless asked for, so requests are not timed at all
+    metrics = Metrics() if args.metrics_json or args.metrics_port is not None else None
+
+    source_env, followers_env = load_config(args.config) if args.config else (sourceEnv, followersEnv)
+    check_env(source_env, followers_env)
+    cfPublic, cfSource, followers = make_clients(source_env, followers_env, metrics=metrics)
+    cache = InstrumentCache(cfPublic)
+    fingerprint = CycleFingerprint()
+
+    try:
+        if not args.daemon:
+            check = check_cycle(cfSource, followers, fingerprint) if not args.dry_run else CycleCheck(False, {})
+            if check.unchanged:
+                print('source positions unchanged and portfolio ratios within', pfratioDriftThreshold, 'of the last cycle, nothing to do')
+                return
+            run_cycle(cfPublic, cfSource, followers, cache, dry_run=args.dry_run, metrics=metrics, fingerprint=fingerprint, prefetched=check.prefetched)
+            return
+
+        if args.metrics_port is not None:
+            serve_metrics(metrics, args.metrics_port)
+
+        # finish the running cycle, then stop on Ctrl+C or SIGTERM
+        stop = threading.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda signum, frame: stop.set())
+        run_daemon(cfPublic, cfSource, followers, cache, stop, dry_run=args.dry_run, metrics=metrics, fingerprint=fingerprint)
+    finally:
+        if args.metrics_json:
+            write_metrics(metrics, args.metrics_json)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+# Local mock of the Kraken Futures REST API, for testing and benchmarking without accounts or network.
+#
+#   python mock_server.py --port 8080 --symbols 300 --positions 20 --latency 0.05
+#   KRAKEN_API_PATH=http://127.0.0.1:8080 python main.py
+#
+# It implements the endpoints cfApiMethods uses. Requests are not authenticated: the APIKey header selects the
+# account, sourceKey is the source account and any other key gets its own follower account on first use.
+
+import argparse
+import datetime
+import json
+import math
+import random
+import socket
+import threading
+import time
+import urllib.parse as urllib
+import http.server
+
+from main import cfRateLimiter
+
+# one account: signed position sizes, resting orders and fills, newest fill last
+class MockAccount(object):
+    def __init__(self, portfolioValue, positions):
+        self.portfolioValue = portfolioValue
+        self.positions = positions  # symbol -> signed size
+        self.orders = {}  # order_id -> open order
+        self.fills = []
+
+class MockExchange(object):
+    def __init__(self, symbols=300, positions=20, sourceKey="source", sourceValue=250000, followerValue=2500,
+                 latency=0.0, jitter=0.0, connectLatency=0.0, errorRate=0.0, throttleRate=0.0, rateLimit=None, fill="none", marginLevels=10,
+                 historyDays=7, historyTrades=2000, seed=1):
+        self.rnd = random.Random(seed)
+        self.lock = threading.Lock()
+        self.latency = latency  # seconds added to every request
+        self.jitter = jitter  # random extra seconds, up to this much
+        self.connectLatency = connectLatency  # seconds added to every new connection, like a TLS handshake
+        self.errorRate = errorRate  # share of requests answered with HTTP 500
+        self.throttleRate = throttleRate  # share of private requests answered with HTTP 429 apiLimitExceeded
+        self.rateLimit = rateLimit  # (capacity, window seconds) of the derivatives budget per key, None for no limit
+        self.budgets = {}  # key -> [tokens, last update]
+        self.costs = cfRateLimiter()  # same costs as the client
+        self.throttled = 0
+        self.fill = fill  # "none": orders rest, "cross": orders at or through the mark price fill, "book": orders at or through the opposite top of the order book fill
+        self.spread = 0.0005  # relative distance between the mark price and each level of the order book
+        self.sourceKey = sourceKey
+        self.followerValue = followerValue
+        self.requests = {}  # endpoint -> count
+        self.connections = 0
+        self.ordersPlaced = 0
+        self.nextId = 0
+        self.historyDays = historyDays  # days of price and source execution history
+        self.historyTrades = historyTrades  # source executions in that history
+        self.priceHistory = {}  # symbol -> [(timestamp, price)], one per minute, generated on first use
+        self.executionHistory = None
+        self.historyEnd = int(time.time() * 1000)
+
+        names = [ 'PF_M%04dUSD' % n for n in range(symbols) ]
+        self.instruments = []
+        self.markPrices = {}
+        self.tickSizes = {}
+        for s in names:
+            tickSize = self.rnd.choice([0.5, 0.1, 0.01, 0.0001])
+            self.instruments.append({
+                'symbol': s, 'type': 'flexible_futures', 'tradeable': True, 'underlying': s[3:-3] + 'USD',
+                'tickSize': tickSize, 'contractSize': 1, 'contractValueTradePrecision': self.rnd.choice([0, 1, 2, 3, 4]),
+                'impactMidSize': 1, 'maxPositionSize': 1000000, 'openingDate': '2022-01-01T00:00:00.000Z',
+                'marginLevels': [ {'numNonContractUnits': 10000 * (n + 1), 'initialMargin': 0.02 * (n + 1), 'maintenanceMargin': 0.01 * (n + 1)}
+                                  for n in range(marginLevels) ],
+                'fundingRateCoefficient': 8, 'maxRelativeFundingRate': 0.001, 'postOnly': False, 'feeScheduleUid': 'eef90775-995b-4596-9257-0917f6134766', 'retailMarginLevels': [], 'category': '', 'tags': [],
+            })
+            self.markPrices[s] = round(self.rnd.uniform(0.05, 60000), 4)
+            self.tickSizes[s] = tickSize
+
+        self.accounts = {
+            sourceKey: MockAccount(sourceValue, { s: self.rnd.choice([-1, 1]) * round(self.rnd.uniform(0.1, 100), 2) for s in self.rnd.sample(names, positions) }),
+        }
+
+    # the account for an API key, creating a follower that holds part of the source book plus some symbols of its own
+    def account(self, key):
+        if key not in self.accounts:
+            source = self.accounts[self.sourceKey]
+            ratio = self.followerValue / source.portfolioValue
+            held = { s: size * ratio * self.rnd.uniform(0.5, 1.5) for s, size in source.positions.items() if self.rnd.random() < 0.7 }
+            for s in self.rnd.sample(sorted(self.markPrices), min(3, len(self.markPrices))):
+                held.setdefault(s, self.rnd.uniform(-1, 1))
+            self.accounts[key] = MockAccount(self.followerValue, held)
+        return self.accounts[key]
+
+    def new_id(self):
+        self.nextId += 1
+        return 'mock-%08d' % self.nextId
+
+    # price of the n-th order book level on the given side ("bids" or "asks"), on the tick grid
+    def level(self, s, side, n):
+        tickSize = self.tickSizes[s]
+        if side == 'asks':
+            return round(math.ceil(self.markPrices[s] * (1 + self.spread * n) / tickSize) * tickSize, 10)
+        return round(math.floor(self.markPrices[s] * (1 - self.spread * n) / tickSize) * tickSize, 10)
+
+    # True if a limit order at this price fills right away under the fill setting
+    def fills_at(self, s, side, limitPrice):
+        if self.fill == 'cross':
+            price = self.markPrices[s]
+        elif self.fill == 'book':
+            price = self.level(s, 'asks' if side == 'buy' else 'bids', 1)
+        else:
+            return False
+        return limitPrice >= price - 1e-9 if side == 'buy' else limitPrice <= price + 1e-9
+
+    # places an order for the account, filling it at once when it crosses the mark price or the book (see fill)
+    def place(self, account, order):
+        s = order.get('symbol')
+        if s not in self.markPrices:
+            return {'status': 'invalidSymbol'}
+        side = order.get('side')
+        size = float(order.get('size', 0))
+        limitPrice = float(order.get('limitPrice', 0))
+        reduceOnly = order.get('reduceOnly') in (True, 'true')
+        if size <= 0:
+            return {'status': 'invalidSize'}
+        if reduceOnly and (s not in account.positions or (account.positions[s] > 0) == (side == 'buy')):
+            return {'status': 'wouldNotReducePosition'}
+
+        order_id = self.new_id()
+        self.ordersPlaced += 1
+        if self.fills_at(s, side, limitPrice):
+            self.execute(account, order_id, s, side, size, limitPrice)
+            return {'status': 'placed', 'order_id': order_id, 'orderEvents': [{'type': 'EXECUTION', 'amount': size, 'price': limitPrice}]}
+
+        account.orders[order_id] = {
+            'order_id': order_id, 'symbol': s, 'side': side, 'orderType': order.get('orderType', 'lmt'),
+            'limitPrice': limitPrice, 'unfilledSize': size, 'filledSize': 0, 'reduceOnly': reduceOnly,
+            'receivedTime': now_iso(), 'lastUpdateTime': now_iso(), 'status': 'untouched',
+        }
+        if order.get('cliOrdId'):
+            account.orders[order_id]['cliOrdId'] = order['cliOrdId']
+        return {'status': 'placed', 'order_id': order_id, 'orderEvents': [{'type': 'PLACE', 'order': account.orders[order_id]}]}
+
+    # amends the size (the whole order size, filled part included) or limit price of a resting order
+    def edit(self, account, order_id, edit):
+        o = account.orders.get(order_id)
+        if o is None:
+            return {'status': 'orderForEditNotFound', 'orderId': order_id}
+        if 'size' in edit:
+            o['unfilledSize'] = float(edit['size']) - o['filledSize']
+        if 'limitPrice' in edit:
+            o['limitPrice'] = float(edit['limitPrice'])
+        o['lastUpdateTime'] = now_iso()
+        self.match(account)
+        return {'status': 'edited', 'orderId': order_id}
+
+    def execute(self, account, order_id, s, side, size, price):
+        account.positions[s] = account.positions.get(s, 0) + (size if side == 'buy' else -size)
+        if abs(account.positions[s]) < 1e-12:
+            del account.positions[s]
+        account.fills.append({'fill_id': self.new_id(), 'symbol': s, 'side': side, 'order_id': order_id,
+                              'size': size, 'price': price, 'fillTime': now_iso(), 'fillType': 'maker'})
+
+    # fills resting orders whose limit the market has reached
+    def match(self, account):
+        for order_id, o in list(account.orders.items()):
+            if self.fills_at(o['symbol'], o['side'], o['limitPrice']):
+                del account.orders[order_id]
+                self.execute(account, order_id, o['symbol'], o['side'], o['unfilledSize'], o['limitPrice'])
+
+    # moves every mark price by a random relative step, up to `step`
+    def move_prices(self, step):
+        with self.lock:
+            for s in self.markPrices:
+                self.markPrices[s] = round(self.markPrices[s] * (1 + self.rnd.uniform(-step, step)), 4)
+            for account in self.accounts.values():
+                self.match(account)
+
+    # charges the request to the budget of its key, False if the budget is exhausted
+    def charge(self, key, path, queryString, body):
+        c = self.costs.cost(path, queryString, body)
+        if self.rateLimit is None or c is None or c[0] != 'derivatives':
+            return True
+        capacity, window = self.rateLimit
+        now = time.monotonic()
+        budget = self.budgets.setdefault(key, [capacity, now])
+        budget[0] = min(capacity, budget[0] + (now - budget[1]) * capacity / window)
+        budget[1] = now
+        if budget[0] < min(c[1], capacity):
+            return False
+        budget[0] -= c[1]
+        return True
+
+    # answers one request, returns (HTTP status, response object, extra headers)
+    def handle(self, method, path, query, form, key, queryString='', body=''):
+        endpoint = path.split('/derivatives/api/v3/')[-1]
+        self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+        if self.errorRate and self.rnd.random() < self.errorRate:
+            return 500, {'result': 'error', 'error': 'injected'}, {}
+        if (self.throttleRate and key and self.rnd.random() < self.throttleRate) or not self.charge(key, path, queryString, body):
+            self.throttled += 1
+            return 429, {'result': 'error', 'error': 'apiLimitExceeded'}, {}
+
+        if path.startswith('/api/history/v2/'):
+            return self.history(path[len('/api/history/v2/'):], query)
+        if endpoint == 'instruments':
+            return 200, {'result': 'success', 'instruments': self.instruments}, {}
+        if endpoint == 'tickers':
+            return 200, {'result': 'success', 'tickers': [ {'symbol': s, 'markPrice': p, 'bid': p, 'ask': p, 'last': p, 'vol24h': 1000, 'suspended': False, 'tag': 'perpetual'}
+                                                           for s, p in self.markPrices.items() ]}, {}
+        if endpoint == 'orderbook':
+            s = query.get('symbol')
+            if s not in self.markPrices:
+                return 200, {'result': 'error', 'error': 'Contract_not_found'}, {}
+            return 200, {'result': 'success', 'orderBook': {'bids': [[self.level(s, 'bids', n), 10] for n in range(1, 11)],
+                                                           'asks': [[self.level(s, 'asks', n), 10] for n in range(1, 11)]}}, {}
+
+        account = self.account(key)
+        if endpoint == 'accounts':
+            return 200, {'result': 'success', 'accounts': {'flex': {'type': 'multiCollateralMarginAccount', 'portfolioValue': account.portfolioValue}}}, {}
+        if endpoint == 'openpositions':
+            return 200, {'result': 'success', 'serverTime': now_iso(), 'openPositions': [ {'symbol': s, 'side': 'long' if size > 0 else 'short', 'size': abs(size), 'price': self.markPrices[s], 'fillTime': now_iso()}
+                                                                 for s, size in account.positions.items() ]}, {}
+        if endpoint == 'openorders':
+            return 200, {'result': 'success', 'openOrders': list(account.orders.values())}, {}
+        if endpoint == 'fills':
+            # like the exchange: the newest 100 fills, or the 100 before lastFillTime
+            fills = account.fills
+            if query.get('lastFillTime'):
+                fills = [ f for f in fills if f['fillTime'] < query['lastFillTime'] ]
+            return 200, {'result': 'success', 'serverTime': now_iso(), 'fills': list(reversed(fills[-100:]))}, {}
+        if endpoint == 'sendorder':
+            return 200, {'result': 'success', 'sendStatus': self.place(account, form)}, {}
+        if endpoint == 'batchorder':
+            statuses = []
+            for instruction in json.loads(form['json'])['batchOrder']:
+                if instruction.get('order') == 'send':
+                    status = self.place(account, instruction)
+                    status['order_tag'] = instruction.get('order_tag')  # like the exchange, only sends answer with their tag
+                elif instruction.get('order') == 'edit':
+                    status = self.edit(account, instruction.get('order_id'), instruction)
+                    status['order_id'] = status.pop('orderId')
+                elif instruction.get('order') == 'cancel':
+                    status = {'status': 'cancelled' if account.orders.pop(instruction.get('order_id'), None) else 'notFound', 'order_id': instruction.get('order_id')}
+                else:
+                    status = {'status': 'invalidArgument'}
+                statuses.append(status)
+            return 200, {'result': 'success', 'batchStatus': statuses}, {}
+        if endpoint == 'editorder':
+            return 200, {'result': 'success', 'editStatus': self.edit(account, form.get('orderId'), form)}, {}
+        if endpoint == 'cancelorder':
+            order_id = form.get('order_id')
+            found = account.orders.pop(order_id, None)
+            return 200, {'result': 'success', 'cancelStatus': {'status': 'cancelled' if found else 'notFound', 'order_id': order_id}}, {}
+        if endpoint == 'cancelallorders':
+            cancelled = [ {'order_id': order_id} for order_id in account.orders ]
+            account.orders.clear()
+            return 200, {'result': 'success', 'cancelStatus': {'status': 'cancelled' if cancelled else 'noOrdersToCancel', 'cancelledOrders': cancelled}}, {}
+        if endpoint == 'cancelallordersafter':
+            return 200, {'result': 'success', 'status': {'currentTime': now_iso(), 'triggerTime': now_iso()}}, {}
+        return 404, {'result': 'error', 'error': 'unknown endpoint ' + path}, {}
+
+    # one price per minute over the history days, a random walk that ends at the current mark price
+    def price_history(self, s):
+        if s not in self.priceHistory:
+            rnd = random.Random('%s-%s' % (self.rnd.random(), s))
+            start = self.historyEnd - self.historyDays * 86400000
+            price = self.markPrices.get(s, 100.0)
+            prices = []
+            for ts in range(self.historyEnd, start, -60000):
+                prices.append((ts, round(price, 4)))
+                price *= 1 + rnd.gauss(0, 0.001)
+            self.priceHistory[s] = prices[::-1]
+        return self.priceHistory[s]
+
+    # executions of the source account in the format of the history API, oldest first
+    def execution_history(self):
+        if self.executionHistory is None:
+            symbols = sorted(self.accounts[self.sourceKey].positions) or sorted(self.markPrices)[:5]
+            start = self.historyEnd - self.historyDays * 86400000
+            executions = []
+            for n in range(self.historyTrades):
+                s = self.rnd.choice(symbols)
+                prices = self.price_history(s)
+                ts = self.rnd.randrange(start, self.historyEnd)
+                price = prices[min(len(prices) - 1, (ts - prices[0][0]) // 60000)][1]
+                ours = {'uid': 'o%d' % n, 'tradeable': s, 'direction': self.rnd.choice(['Buy', 'Sell']), 'quantity': '%.4f' % self.rnd.uniform(0.01, 5), 'accountUid': 'source-account'}
+                theirs = {'uid': 'c%d' % n, 'tradeable': s, 'direction': 'Sell' if ours['direction'] == 'Buy' else 'Buy', 'quantity': ours['quantity'], 'accountUid': 'counterparty-%d' % self.rnd.randrange(50)}
+                maker, taker = (ours, theirs) if self.rnd.random() < 0.5 else (theirs, ours)
+                executions.append({'uid': 'x%d' % n, 'timestamp': ts, 'event': {'execution': {'execution': {
+                    'uid': 'x%d' % n, 'makerOrder': maker, 'takerOrder': taker, 'timestamp': ts, 'quantity': ours['quantity'], 'price': str(price), 'markPrice': str(price)}}}})
+            executions.sort(key=lambda e: e['timestamp'])
+            self.executionHistory = executions
+        return self.executionHistory
+
+    # history API: source executions and market prices honour since, before and sort; other element types are synthetic.
+    # Pages come with continuation tokens.
+    def history(self, kind, query):
+        if kind == 'executions' or (kind.startswith('market/') and kind.endswith('/price')):
+            if kind == 'executions':
+                elements = self.execution_history()
+            else:
+                elements = [ {'uid': '%s-%d' % (kind, ts), 'timestamp': ts, 'event': {'price': str(price)}} for ts, price in self.price_history(kind.split('/')[1]) ]
+            if query.get('since'):
+                elements = [ e for e in elements if e['timestamp'] >= int(query['since']) ]
+            if query.get('before'):
+                elements = [ e for e in elements if e['timestamp'] < int(query['before']) ]
+            if query.get('sort', 'desc') == 'desc':
+                elements = elements[::-1]
+            pageSize = 1000
+        else:
+            elements = [ {'uid': 'e%d' % n, 'timestamp': 1700000000000 + n * 1000, 'price': 100 + n % 7} for n in range(1000) ]
+            pageSize = 100
+        start = int(query.get('continuationToken') or 0)
+        page = elements[start:start + pageSize]
+        truncated = start + pageSize < len(elements)
+        headers = {'is-truncated': 'true' if truncated else 'false'}
+        if truncated:
+            headers['next-continuation-token'] = str(start + pageSize)
+        return 200, {'elements': page, 'len': len(page)}, headers
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def make_handler(exchange):
+    class MockHandler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'  # keep-alive
+
+        def setup(self):
+            super().setup()
+            # headers and body are written separately, without this Nagle's algorithm stalls keep-alive responses
+            self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            with exchange.lock:
+                exchange.connections += 1
+            if exchange.connectLatency:
+                time.sleep(exchange.connectLatency)
+
+        def handle_request(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            body = self.rfile.read(length).decode() if length else ''
+            parsed = urllib.urlsplit(self.path)
+            query = dict(urllib.parse_qsl(parsed.query))
+            form = dict(urllib.parse_qsl(body))
+
+            delay = exchange.latency + (exchange.rnd.uniform(0, exchange.jitter) if exchange.jitter else 0)
+            if delay:
+                time.sleep(delay)
+            with exchange.lock:
+                status, response, headers = exchange.handle(self.command, parsed.path, query, form, self.headers.get('APIKey', ''), parsed.query, body)
+
+            data = json.dumps(response).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            for k, v in headers.items():
+                self.send_header(k, v)
+            self.end_headers()
+            self.wfile.write(data)
+
+        do_GET = handle_request
+        do_POST = handle_request
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockHandler
+
+class MockServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # many followers connect at once
+
+# starts the mock server in a background thread, port 0 picks a free port (server.server_port)
+def start_mock_server(exchange, host="127.0.0.1", port=0):
+    server = MockServer((host, port), make_handler(exchange))
+    threading.Thread(target=server.serve_forever, name='mock-server', daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Local mock of the Kraken Futures REST API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--symbols", type=int, default=300, help="listed instruments")
+    parser.add_argument("--positions", type=int, default=20, help="positions held by the source account")
+    parser.add_argument("--source-key", default="source", help="APIKey of the source account")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="random extra seconds per request, up to this much")
+    parser.add_argument("--connect-latency", type=float, default=0.0, help="seconds added to every new connection")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with HTTP 500")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of private requests answered with HTTP 429 apiLimitExceeded")
+    parser.add_argument("--rate-limit", type=float, nargs=2, metavar=("CAPACITY", "WINDOW"), help="enforce a cost budget per key, like 500 10 on the exchange")
+    parser.add_argument("--fill", choices=("none", "cross", "book"), default="none", help="let orders at or through the mark price (cross) or the top of the order book (book) fill")
+    parser.add_argument("--history-days", type=int, default=7, help="days of market prices and source executions in the history API")
+    parser.add_argument("--history-trades", type=int, default=2000, help="source executions in that history")
+    parser.add_argument("--volatility", type=float, default=0.0, help="relative mark price step every second")
+    args = parser.parse_args()
+
+    exchange = MockExchange(symbols=args.symbols, positions=args.positions, sourceKey=args.source_key, latency=args.latency, jitter=args.jitter,
+                            connectLatency=args.connect_latency, errorRate=args.error_rate, throttleRate=args.throttle_rate,
+                            rateLimit=args.rate_limit, fill=args.fill, historyDays=args.history_days, historyTrades=args.history_trades)
+    server = start_mock_server(exchange, args.host, args.port)
+    print('mock Kraken Futures API at http://%s:%d' % (args.host, server.server_port))
+    try:
+        while True:
+            time.sleep(1)
+            if args.volatility:
+                exchange.move_prices(args.volatility)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,299 @@
+# Replays the source account's trading history to measure what the copy cadence costs, without accounts other than the source.
+#
+#   python replay.py download --days 30     fetch new source executions and market prices into the local store
+#   python replay.py simulate               copy the stored history at several poll intervals and latencies
+#
+# The store keeps one file per column of fixed-size values, appended on every download and read back through mmap,
+# so months of ticks are never loaded into memory at once. It uses the same KRAKEN_SOURCE_KEY / KRAKEN_SOURCE_SECRET
+# and KRAKEN_API_PATH as main.py; point KRAKEN_API_PATH at mock_server.py to try it without an account.
+
+import argparse
+import array
+import bisect
+import collections
+import contextlib
+import itertools
+import json
+import mmap
+import os
+import time
+
+import main as copytrader
+from main import cfApiMethods, cfConnectionPool
+
+dataDir = os.path.join(copytrader.cacheDir, "replay")
+flushRows = 10000  # rows buffered in memory before they are appended to the column files
+
+# requests of the resident mode: one source positions poll per interval, a full cycle when the source changed
+pollRequests = 1
+cycleRequests = 8
+
+# append-only table with one file per column. Rows are committed by writing the row count to meta.json after the
+# column files, so rows of an interrupted download are cut off on the next open.
+class ColumnStore(object):
+    def __init__(self, directory, columns):
+        self.directory = directory
+        self.columns = columns  # column name -> array typecode
+        self.meta = {'rows': 0}
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(os.path.join(directory, 'meta.json')) as f:
+                self.meta = json.load(f)
+        except (OSError, ValueError):
+            pass
+        for name, typecode in columns.items():
+            path = self.path(name)
+            size = self.meta['rows'] * array.array(typecode).itemsize
+            if not os.path.exists(path) or os.path.getsize(path) != size:
+                with open(path, 'ab') as f:
+                    f.truncate(size)
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.' + self.columns[name])
+
+    def __len__(self):
+        return self.meta['rows']
+
+    # appends rows given as one list per column and commits them together with the updated meta fields
+    def append(self, values, **meta):
+        rows = len(next(iter(values.values())))
+        for name, typecode in self.columns.items():
+            with open(self.path(name), 'ab') as f:
+                f.write(array.array(typecode, values[name]).tobytes())
+        self.meta.update(meta, rows=self.meta['rows'] + rows)
+        copytrader.write_json_atomic(os.path.join(self.directory, 'meta.json'), self.meta)
+
+    # the committed rows of every column as memoryviews over mmapped files, valid inside the with block
+    @contextlib.contextmanager
+    def columns_view(self):
+        with contextlib.ExitStack() as stack:
+            views = {}
+            for name, typecode in self.columns.items():
+                if not self.meta['rows']:
+                    views[name] = memoryview(array.array(typecode))
+                    continue
+                f = stack.enter_context(open(self.path(name), 'rb'))
+                mm = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+                view = stack.enter_context(memoryview(mm))
+                views[name] = stack.enter_context(view.cast(typecode)[:self.meta['rows']])
+            try:
+                yield views
+            finally:
+                for view in views.values():
+                    view.release()
+
+def execution_store():
+    return ColumnStore(os.path.join(dataDir, 'executions'), {'timestamp': 'q', 'symbol': 'i', 'size': 'd', 'price': 'd'})
+
+def price_store(symbol):
+    return ColumnStore(os.path.join(dataDir, 'prices', symbol), {'timestamp': 'q', 'price': 'd'})
+
+# the executed order of the account in a history execution element, detecting the account from the first elements
+def own_order(execution, accountUid):
+    maker, taker = execution.get('makerOrder', {}), execution.get('takerOrder', {})
+    if maker.get('accountUid') == accountUid:
+        return maker
+    if taker.get('accountUid') == accountUid:
+        return taker
+    return None
+
+def detect_account(elements):
+    counts = collections.Counter()
+    for e in elements:
+        execution = e['event']['execution']['execution']
+        for order in (execution.get('makerOrder', {}), execution.get('takerOrder', {})):
+            if order.get('accountUid'):
+                counts[order['accountUid']] += 1
+    return counts.most_common(1)[0][0] if counts else None
+
+def element_price(e):
+    event = e.get('event', {})
+    return float(event['price'] if isinstance(event, dict) and 'price' in event else e['price'])
+
+# appends the elements newer than the store's cursor, in batches of flushRows; elements at the cursor timestamp are
+# skipped by uid because since is inclusive. to_row returns a dict of column values or None to skip the element,
+# meta returns fields committed with every batch.
+def append_new(store, elements, to_row, meta=dict):
+    cursor, seen = store.meta.get('cursor', 0), set(store.meta.get('cursorUids', []))
+    batch = { name: [] for name in store.columns }
+    added = 0
+    for e in elements:
+        ts = e['timestamp']
+        if ts < cursor or (ts == cursor and e['uid'] in seen):
+            continue
+        row = to_row(e)
+        if row is not None:
+            for name in batch:
+                batch[name].append(row[name])
+        seen = seen | {e['uid']} if ts == cursor else {e['uid']}
+        cursor = ts
+        if len(batch['timestamp']) >= flushRows:
+            added += len(batch['timestamp'])
+            store.append(batch, cursor=cursor, cursorUids=sorted(seen), **meta())
+            batch = { name: [] for name in store.columns }
+    added += len(batch['timestamp'])
+    store.append(batch, cursor=cursor, cursorUids=sorted(seen), **meta())
+    return added
+
+def download(client, days, symbols=None):
+    since = int((time.time() - days * 86400) * 1000)
+
+    executions = execution_store()
+    start = executions.meta.get('cursor', since)
+    symbolIds = { s: n for n, s in enumerate(executions.meta.get('symbols', [])) }
+    accountUid = executions.meta.get('accountUid')
+    elements = client.iter_executions(since=start, sort='asc')
+
+    def to_row(e):
+        execution = e['event']['execution']['execution']
+        order = own_order(execution, accountUid)
+        if order is None:
+            return None
+        symbol = order['tradeable']
+        size = float(execution['quantity']) * ( 1 if order['direction'] == 'Buy' else -1 )
+        return {'timestamp': e['timestamp'], 'symbol': symbolIds.setdefault(symbol, len(symbolIds)), 'size': size, 'price': float(execution['price'])}
+
+    if accountUid is None:
+        first = [ e for _, e in zip(range(100), elements) ]
+        accountUid = detect_account(first)
+        elements = itertools.chain(first, elements)
+    added = append_new(executions, elements, to_row, lambda: {'symbols': sorted(symbolIds, key=symbolIds.get), 'accountUid': accountUid})
+    print('executions: %d new, %d stored' % (added, len(executions)))
+
+    # the current positions anchor the replay: positions at the start are these minus all stored executions
+    positions = client.get_openpositions()['openPositions']
+    with open(os.path.join(dataDir, 'positions.json'), 'w') as f:
+        json.dump({ 'timestamp': int(time.time() * 1000), 'positions': { p['symbol']: p['size'] * ( 1 if p['side'] == 'long' else -1 ) for p in positions } }, f)
+
+    for symbol in symbols or sorted(symbolIds):
+        prices = price_store(symbol)
+        added = append_new(prices, client.iter_market_price(symbol, since=prices.meta.get('cursor', since), sort='asc'),
+                           lambda e: {'timestamp': e['timestamp'], 'price': element_price(e)})
+        print('%s prices: %d new, %d stored' % (symbol, added, len(prices)))
+
+# price of a symbol at a time: the last stored market price, or the last source execution price without market prices
+class PriceLookup(object):
+    def __init__(self, stack):
+        self.stack = stack
+        self.series = {}
+        self.lastExecution = {}
+
+    def at(self, symbol, ts):
+        if symbol not in self.series:
+            store = price_store(symbol)
+            self.series[symbol] = self.stack.enter_context(store.columns_view()) if len(store) else None
+        series = self.series[symbol]
+        if series is None:
+            return self.lastExecution[symbol]
+        i = bisect.bisect_right(series['timestamp'], ts) - 1
+        return series['price'][max(i, 0)]
+
+# copies the stored source history with the pfratio logic: every `interval` seconds the follower sees the source
+# positions and `latency` seconds later trades to pfratio times them at the market price. The cost is what the follower
+# earns less than pfratio times the source over the same period (size * price, so exact for linear PF_ contracts).
+def simulate(interval, latency, pfratio=1.0):
+    executions = execution_store()
+    with open(os.path.join(dataDir, 'positions.json')) as f:
+        anchor = json.load(f)
+    symbols = executions.meta.get('symbols', [])
+    intervalMs, latencyMs = int(interval * 1000), int(latency * 1000)
+
+    with contextlib.ExitStack() as stack:
+        cols = stack.enter_context(executions.columns_view())
+        prices = PriceLookup(stack)
+        timestamps, symbolIds, sizes, execPrices = cols['timestamp'], cols['symbol'], cols['size'], cols['price']
+        n = len(timestamps)
+        if n == 0:
+            return None
+
+        # positions at the start of the history
+        source = dict(anchor['positions'])
+        for i in range(n):
+            s = symbols[symbolIds[i]]
+            source[s] = source.get(s, 0) - sizes[i]
+        follower = { s: pfratio * size for s, size in source.items() }
+
+        start, end = timestamps[0], max(timestamps[n - 1], anchor['timestamp'])
+        sourceCash = followerCash = notional = lagNotional = 0.0
+        polls = cycles = 0
+        dirty = set()
+        nextPoll = start + intervalMs
+
+        def poll(t):
+            nonlocal followerCash, notional, polls, cycles
+            polls += 1
+            if not dirty:
+                return
+            cycles += 1
+            for s in dirty:
+                delta = pfratio * source[s] - follower.get(s, 0)
+                if delta:
+                    price = prices.at(s, t + latencyMs)
+                    followerCash -= delta * price
+                    notional += abs(delta) * price
+                    follower[s] = pfratio * source[s]
+            dirty.clear()
+
+        for i in range(n):
+            ts = timestamps[i]
+            while nextPoll <= ts:
+                poll(nextPoll)
+                nextPoll += intervalMs
+            s, size, price = symbols[symbolIds[i]], sizes[i], execPrices[i]
+            source[s] = source.get(s, 0) + size
+            sourceCash -= pfratio * size * price
+            prices.lastExecution[s] = price
+            dirty.add(s)
+            # the first poll after the execution copies it
+            lagNotional += abs(pfratio * size * price) * ( (nextPoll - ts + latencyMs) / 1000 )
+        while dirty:
+            poll(nextPoll)
+            nextPoll += intervalMs
+        days = max(end - start, 1) / 86400000
+
+    # both books hold the same positions now, so the difference is all in what was paid for them
+    return {
+        'cost': sourceCash - followerCash,
+        'notional': notional,
+        'lag': lagNotional / notional if notional else 0,
+        'polls_per_day': polls / days,
+        'cycles_per_day': cycles / days,
+        'requests_per_day': (polls * pollRequests + cycles * cycleRequests) / days,
+        'days': days,
+    }
+
+def float_list(value):
+    return [ float(v) for v in value.split(',') ]
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay the source history to measure the cost of the copy cadence.")
+    sub = parser.add_subparsers(dest="command", required=True)
+    dl = sub.add_parser("download", help="fetch new source executions and market prices into the store")
+    dl.add_argument("--days", type=float, default=30, help="history to fetch on the first download")
+    dl.add_argument("--symbols", type=lambda v: v.split(','), help="comma separated symbols to fetch prices for, default every symbol the source traded")
+    sim = sub.add_parser("simulate", help="copy the stored history at several cadences")
+    sim.add_argument("--intervals", type=float_list, default=[5, 15, 60, 300, 900], help="comma separated poll intervals in seconds")
+    sim.add_argument("--latencies", type=float_list, default=[0.5, 2], help="comma separated seconds between poll and order")
+    sim.add_argument("--pfratio", type=float, default=1.0, help="your / source portfolio value")
+    args = parser.parse_args()
+
+    if args.command == "download":
+        copytrader.check_env(copytrader.sourceEnv, [])
+        client = cfApiMethods(copytrader.apiPath, apiPublicKey=os.environ[copytrader.sourceEnv[0]], apiPrivateKey=os.environ[copytrader.sourceEnv[1]],
+                              timeout=copytrader.timeout, checkCertificate=copytrader.checkCertificate, pool=cfConnectionPool())
+        download(client, args.days, args.symbols)
+        client.pool.close()
+        return
+
+    print('%9s %9s %10s %9s %14s %12s %9s %12s %10s' % ('interval', 'latency', 'polls/day', 'cycles/d', 'requests/day', 'cost USD', 'cost bps', 'copied USD', 'lag s'))
+    for interval in args.intervals:
+        for latency in args.latencies:
+            r = simulate(interval, latency, args.pfratio)
+            if r is None:
+                print('no executions stored, run "python replay.py download" first')
+                return
+            print('%9g %9g %10.0f %9.0f %14.0f %12.2f %9.2f %12.0f %10.1f' % (interval, latency, r['polls_per_day'], r['cycles_per_day'], r['requests_per_day'],
+                  r['cost'], r['cost'] / r['notional'] * 1e4 if r['notional'] else 0, r['notional'], r['lag']))
+
+if __name__ == "__main__":
+    main()